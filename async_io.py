@@ -0,0 +1,114 @@
+import asyncio
+import threading
+import configparser
+
+# SCPI instruments listen for raw socket connections on this port
+SCPI_PORT = 5025
+# seconds to wait for an instrument answer
+SCPI_TIMEOUT = 5
+# seconds a whole stage may take before it is cancelled
+STAGE_TIMEOUT = 120
+
+
+def async_enabled(config_file='config.ini'):
+	"""[ASYNC] Enabled, the GUI then runs on a qasync event loop"""
+	config = configparser.ConfigParser()
+	config.read(config_file)
+	return config.getboolean('ASYNC', 'Enabled', fallback=False)
+
+
+def stage_timeout(config_file='config.ini'):
+	config = configparser.ConfigParser()
+	config.read(config_file)
+	return config.getfloat('ASYNC', 'Stage_Timeout', fallback=STAGE_TIMEOUT)
+
+
+def run_sync(loop, coroutine, timeout=None):
+	"""Runs a coroutine on loop from a worker thread and returns its result.
+
+	Never call it on the loop thread itself, it would wait for the loop it blocks.
+	The qasync loop is the Qt event loop, it always runs in the main thread.
+	"""
+	if threading.current_thread() is threading.main_thread():
+		coroutine.close()
+		raise RuntimeError('Blocking call on the event loop thread')
+	return asyncio.run_coroutine_threadsafe(coroutine, loop).result(timeout)
+
+
+class AsyncScpi:
+	"""SCPI over a raw TCP socket, commands and answers are lines"""
+	def __init__(self, host, port=SCPI_PORT, timeout=SCPI_TIMEOUT):
+		self.host = host
+		self.port = port
+		self.timeout = timeout
+		self.reader = None
+		self.writer = None
+		self.lock = asyncio.Lock() # one command and its answer at a time
+
+	@property
+	def connected(self):
+		return self.writer is not None and not self.writer.is_closing()
+
+	async def connect(self):
+		"""Returns the *IDN? answer of the instrument"""
+		self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+		return await self.query('*IDN?')
+
+	async def write(self, command):
+		async with self.lock:
+			await self.send(command)
+
+	async def query(self, command):
+		async with self.lock:
+			return await self.ask(command)
+
+	async def ask(self, command):
+		"""query() for callers that already hold lock"""
+		await self.send(command)
+		answer = await asyncio.wait_for(self.reader.readline(), self.timeout)
+		if not answer:
+			raise ConnectionError(f'{self.host} closed the connection')
+		return answer.decode('ascii', errors='replace').strip()
+
+	async def send(self, command):
+		"""write() for callers that already hold lock"""
+		if not self.connected:
+			raise ConnectionError(f'Not connected to {self.host}')
+		self.writer.write(f'{command}\n'.encode('ascii'))
+		await self.writer.drain()
+
+	def close(self):
+		# no await, also called from the GUI thread while closing the app
+		if self.writer is not None:
+			self.writer.close()
+		self.reader = None
+		self.writer = None
+
+
+async def run_process(args, timeout=None, on_line=None, cwd=None):
+	"""Runs a program, returns (returncode, output lines).
+
+	on_line(line) gets every output line as it arrives. On timeout or
+	cancellation the program is killed before the exception propagates.
+	"""
+	process = await asyncio.create_subprocess_exec(*args, cwd=cwd,
+		stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+	lines = []
+
+	async def read_output():
+		async for raw in process.stdout:
+			line = raw.decode('utf-8', errors='replace').rstrip()
+			lines.append(line)
+			if on_line:
+				on_line(line)
+		return await process.wait()
+
+	try:
+		returncode = await asyncio.wait_for(read_output(), timeout)
+	except BaseException:
+		# TimeoutError and CancelledError alike, nothing keeps running behind the stage
+		if process.returncode is None:
+			process.kill()
+			await process.wait()
+		raise
+	return returncode, lines
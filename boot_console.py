@@ -0,0 +1,113 @@
+import re
+import time
+import threading
+import configparser
+
+import serial
+import serial.tools.list_ports
+
+# ESP-IDF defaults, the ROM prints the reset reason, the application start is logged by IDF
+BOOT_BANNER = r'rst:0x[0-9a-f]+'
+APP_READY = r'Calling app_main\(\)|Starting scheduler'
+
+
+class ConsoleResult:
+	def __init__(self, passed, reason, lines, board_ready=False):
+		self.passed = passed
+		self.reason = reason
+		self.lines = lines # everything captured, for the log on failure
+		self.board_ready = board_ready # passed including the STM and display markers, no operator check needed
+
+	def __str__(self):
+		return f'{"OK" if self.passed else "FAILED"}: {self.reason}'
+
+
+class BootConsole:
+	"""Captures the UART console after programming and waits for the boot markers.
+
+	markers: [(name, regex)] that have to appear in this order. wait() returns
+	as soon as the last one is seen, or after timeout seconds. board_markers
+	tells that the markers include the STM and the display coming up.
+	"""
+	def __init__(self, port, baudrate=115200, markers=None, timeout=10, power_off_time=0.5, board_markers=False):
+		self.port = port
+		self.baudrate = baudrate
+		self.markers = [(name, re.compile(regex)) for name, regex in (markers or [('boot banner', BOOT_BANNER), ('app ready', APP_READY)])]
+		self.timeout = timeout
+		self.power_off_time = power_off_time # the board has to be unpowered this long before it boots again
+		self.board_markers = board_markers
+		self.lines = []
+		self.seen = []
+		self.error = None
+		self.done = threading.Event()
+		self.thread = None
+
+	@classmethod
+	def from_config(cls, config_file='config.ini'):
+		"""None if the capture is disabled in the [CONSOLE] section"""
+		config = configparser.ConfigParser()
+		config.read(config_file)
+		if not config.getboolean('CONSOLE', 'Enabled', fallback=False):
+			return None
+		console = config['CONSOLE']
+		port = console.get('Port', 'auto')
+		if port == 'auto':
+			port = find_console_port() or config.get('ESP', 'COM_Port', fallback=None)
+		markers = [('boot banner', console.get('Boot_Banner', BOOT_BANNER)), ('app ready', console.get('App_Ready', APP_READY))]
+		# the ESP boot alone does not show the STM and the display working, the firmware has to log both
+		board = [('STM ready', console.get('Stm_Ready', '')), ('display ready', console.get('Display_Ready', ''))]
+		board_markers = all(regex for _, regex in board)
+		if board_markers:
+			markers += board
+		return cls(port, console.getint('Baudrate', 115200), markers,
+			console.getfloat('Boot_Timeout', 10), console.getfloat('Power_Off_Time', 0.5), board_markers)
+
+	def start(self):
+		"""Opens the port, call before the board is powered so the banner is not missed"""
+		self.connection = serial.Serial(self.port, self.baudrate, timeout=0.1)
+		self.connection.reset_input_buffer()
+		self.deadline = time.monotonic() + self.timeout
+		self.thread = threading.Thread(target=self.capture, daemon=True)
+		self.thread.start()
+
+	def capture(self):
+		try:
+			pending = b''
+			while len(self.seen) < len(self.markers) and time.monotonic() < self.deadline:
+				pending += self.connection.read(self.connection.in_waiting or 1)
+				*lines, pending = pending.split(b'\n')
+				for line in lines:
+					self.check_line(line.decode('utf-8', errors='replace').strip())
+		except (serial.SerialException, OSError) as e:
+			self.error = e
+		finally:
+			self.connection.close()
+			self.done.set()
+
+	def check_line(self, line):
+		if not line:
+			return
+		self.lines.append(line)
+		if len(self.seen) == len(self.markers):
+			return
+		name, pattern = self.markers[len(self.seen)]
+		if pattern.search(line):
+			print(f'Console: {name} after {self.timeout - (self.deadline - time.monotonic()):.1f} s')
+			self.seen.append(name)
+
+	def wait(self):
+		self.done.wait(self.timeout + 1)
+		if self.error:
+			return ConsoleResult(False, f'console port error: {self.error}', self.lines)
+		if len(self.seen) == len(self.markers):
+			return ConsoleResult(True, ', '.join(self.seen), self.lines, self.board_markers)
+		missing = self.markers[len(self.seen)][0]
+		return ConsoleResult(False, f'{missing} not seen within {self.timeout} s', self.lines)
+
+
+def find_console_port():
+	# the same USB serial adapter the ESP is programmed through
+	for port in serial.tools.list_ports.comports():
+		if 'USB Serial Port' in port.description:
+			return port.device
+	return None
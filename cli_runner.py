@@ -0,0 +1,138 @@
+import re
+import time
+import queue
+import threading
+import subprocess
+
+FATAL = 'fatal'
+PROBE = 'probe' # fatal, the probe could not talk to the target
+PROGRESS = 'progress'
+
+
+def compile_patterns(table):
+	"""Compiles a list of (kind, regex) pairs"""
+	return [(kind, re.compile(pattern)) for kind, pattern in table]
+
+
+# ST-LINK_CLI output
+STLINK_PATTERNS = compile_patterns([
+	(PROBE, r'No ST-LINK detected'),
+	(PROBE, r'Unable to connect to ST-LINK'),
+	(PROBE, r'No target connected'),
+	(PROBE, r'Elf Loader could not be transfered to device'),
+	(FATAL, r'Read out protection is activated'),
+	(FATAL, r'Error occured during program operation'),
+	(FATAL, r'Unexpected error'),
+	(PROGRESS, r'Connected via SWD'),
+	(PROGRESS, r'(?:Flash|Memory) (?:memory )?programmed in'),
+	(PROGRESS, r'Verification\.*OK'),
+	(PROGRESS, r'(\d+)%'),
+])
+
+# OpenOCD output (job scripts)
+OPENOCD_PATTERNS = compile_patterns([
+	(FATAL, r'^FAILED '),
+	(PROBE, r'Error: open failed'),
+	(PROBE, r'Error: init mode failed'),
+	(PROGRESS, r'^STEP '),
+	(PROGRESS, r'^wrote \d+ bytes'),
+	(PROGRESS, r'^verified \d+ bytes'),
+])
+
+
+class CommandResult:
+	def __init__(self, returncode, lines, failure=None, probe_error=False):
+		self.returncode = returncode
+		self.lines = lines
+		self.failure = failure # reason why the command failed or was killed
+		self.probe_error = probe_error # failure was a connect or communication error
+
+	@property
+	def ok(self):
+		return self.failure is None and self.returncode == 0
+
+	@property
+	def output(self):
+		return '\n'.join(self.lines)
+
+
+class StreamingCommand:
+	"""Runs a CLI tool and reads its output line by line as it arrives.
+
+	The process is killed as soon as a fatal pattern shows up, when it
+	stays silent for inactivity_timeout seconds or when it runs longer
+	than max_time seconds.
+	"""
+	def __init__(self, cmd, patterns, inactivity_timeout=30, max_time=300, on_progress=None):
+		self.cmd = cmd
+		self.patterns = patterns
+		self.inactivity_timeout = inactivity_timeout
+		self.max_time = max_time
+		self.on_progress = on_progress
+
+	def run(self):
+		try:
+			process = subprocess.Popen(self.cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors='replace', bufsize=1)
+		except OSError as e:
+			return CommandResult(None, [], f'could not start: {e}')
+
+		# reading happens in a thread, pipes can't be polled with a timeout on Windows
+		lines = queue.Queue()
+		reader = threading.Thread(target=self.read_output, args=(process.stdout, lines), daemon=True)
+		reader.start()
+
+		output = []
+		failure = None
+		probe_error = False
+		started = time.monotonic()
+		while True:
+			timeout = min(self.inactivity_timeout, self.max_time - (time.monotonic() - started))
+			if timeout <= 0:
+				failure = f'no result after {self.max_time} s'
+				break
+			try:
+				line = lines.get(timeout=timeout)
+			except queue.Empty:
+				if time.monotonic() - started >= self.max_time:
+					failure = f'no result after {self.max_time} s'
+				else:
+					failure = f'no output for {self.inactivity_timeout} s'
+				break
+			if line is None: # end of output
+				break
+
+			output.append(line)
+			kind = self.match(line)
+			if kind in (FATAL, PROBE):
+				failure = line
+				probe_error = kind == PROBE
+				break
+
+		if failure:
+			process.kill()
+		try:
+			returncode = process.wait(timeout=5)
+		except subprocess.TimeoutExpired:
+			process.kill()
+			returncode = process.wait()
+		reader.join(timeout=1)
+
+		if failure:
+			print(f'Command {self.cmd[0]} stopped: {failure}')
+		return CommandResult(returncode, output, failure, probe_error)
+
+	def match(self, line):
+		for kind, pattern in self.patterns:
+			if not pattern.search(line):
+				continue
+			if kind == PROGRESS and self.on_progress:
+				self.on_progress(line)
+			return kind
+		return None
+
+	@staticmethod
+	def read_output(stream, lines):
+		for line in stream:
+			lines.put(line.rstrip('\r\n'))
+		stream.close()
+		lines.put(None)
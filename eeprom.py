@@ -0,0 +1,87 @@
+import json
+
+# STM32L0 data EEPROM
+EEPROM_BASE = 0x08080000
+EEPROM_ERASED = 0x00 # value of an erased data EEPROM byte
+
+# fields stored with their bytes in reversed order (EUI)
+REVERSED_ADDRESSES = ('0x08080008',)
+
+
+def encode_value(address, value):
+	"""Converts a profile value to the bytes that end up in the EEPROM.
+
+	Follows the original per-field writes: values up to one byte were written
+	with -w8, up to four bytes with -w32 (little endian word) and anything
+	longer byte by byte (reversed for the EUI).
+	"""
+	if value.isdigit():
+		value = int(value)
+		if value < 256:
+			value = f'0x{value:02x}'
+		else:
+			value = f'0x{value:X}'
+	else:
+		byte_value = value.encode('utf-8')
+		value = '0x' + ''.join(f'{byte:02X}' for byte in byte_value)
+
+	clean_value = value.lower().replace('0x', '')
+	if len(clean_value) % 2 != 0:
+		clean_value = '0' + clean_value
+	byte_data = bytes.fromhex(clean_value)
+
+	if len(byte_data) <= 1: # 8-bit value
+		return byte_data
+	elif len(byte_data) <= 4: # 32-bit value
+		return int.from_bytes(byte_data, 'big').to_bytes(4, 'little')
+	elif address in REVERSED_ADDRESSES:
+		return byte_data[::-1]
+	return byte_data
+
+
+class EepromImage:
+	"""Contiguous EEPROM image compiled from a device profile (data/*.json)"""
+	def __init__(self, base=EEPROM_BASE):
+		self.base = base
+		self.data = bytearray()
+		self.fields = [] # (name, address, length)
+
+	@classmethod
+	def from_profile(cls, path, base=EEPROM_BASE):
+		with open(path, 'r') as file:
+			profile = json.load(file)
+
+		image = cls(base)
+		for item in profile:
+			address = item.get('address')
+			value = item.get('value')
+			if not value:
+				continue
+			image.put(item.get('name'), address, encode_value(address, value))
+		return image
+
+	def put(self, name, address, data):
+		"""Places data at the given address, later fields overwrite earlier ones"""
+		offset = int(address, 16) - self.base
+		if offset < 0:
+			raise ValueError(f'Address {address} of "{name}" is below EEPROM base 0x{self.base:08X}')
+
+		end = offset + len(data)
+		if end > len(self.data):
+			self.data.extend(bytes([EEPROM_ERASED]) * (end - len(self.data)))
+		self.data[offset:end] = data
+		self.fields.append((name, self.base + offset, len(data)))
+
+	def mismatched_fields(self, data):
+		"""Names of the fields whose bytes in data (read back from base) differ from the image"""
+		names = []
+		for name, address, length in self.fields:
+			offset = address - self.base
+			if data[offset:offset + length] != self.data[offset:offset + length]:
+				names.append(name)
+		if not names and bytes(data) != bytes(self.data):
+			names.append('gap between fields')
+		return names
+
+	def __len__(self):
+		return len(self.data)
@@ -0,0 +1,65 @@
+import os
+
+# STM32L0 read out protection levels, level 0 is RDP byte 0xAA, level 2 is 0xCC
+RDP_LEVEL_0 = 0xAA
+RDP_LEVEL_2 = 0xCC
+
+
+def rdp_level(rdp_byte):
+	if rdp_byte == RDP_LEVEL_0:
+		return 0
+	if rdp_byte == RDP_LEVEL_2:
+		return 2
+	return 1
+
+
+class ErasePlan:
+	def __init__(self, remove_protection, sector_ranges):
+		self.remove_protection = remove_protection # RDP regression (mass erases the whole chip)
+		self.sector_ranges = sector_ranges # [(first, last), ...] to erase afterwards
+
+	def __str__(self):
+		ranges = ', '.join(f'{first}-{last}' for first, last in self.sector_ranges) or 'none'
+		return f'remove protection: {self.remove_protection}, sectors: {ranges}'
+
+
+class ErasePlanner:
+	"""Plans the erase from the extents of the images that are going to be programmed.
+
+	The data EEPROM needs no erase, it is byte writable and the compiled
+	profile image rewrites its whole range.
+	"""
+	def __init__(self, flash_base, sector_size):
+		self.flash_base = flash_base
+		self.sector_size = sector_size
+
+	def sectors(self, address, size):
+		first = (address - self.flash_base) // self.sector_size
+		last = (address + size - 1 - self.flash_base) // self.sector_size
+		return first, last
+
+	def sector_ranges(self, images):
+		"""images: [(path, address)], returns merged sector ranges"""
+		sectors = []
+		for path, address in images:
+			size = os.path.getsize(path)
+			if size:
+				sectors.append(self.sectors(address, size))
+
+		ranges = []
+		for first, last in sorted(sectors):
+			if ranges and first <= ranges[-1][1] + 1:
+				ranges[-1] = (ranges[-1][0], max(last, ranges[-1][1]))
+			else:
+				ranges.append((first, last))
+		return ranges
+
+	def plan(self, rdp, images):
+		"""rdp: level read from the option bytes, None if they could not be read"""
+		if rdp is None:
+			# unknown state, remove the protection as before and erase what will be programmed
+			return ErasePlan(True, self.sector_ranges(images))
+		if rdp != 0:
+			# the regression to level 0 already leaves flash and EEPROM empty
+			return ErasePlan(True, [])
+		return ErasePlan(False, self.sector_ranges(images))
@@ -1,36 +1,43 @@
-
-
-import re
-import io
-import sys
-import time
 import serial
 import serial.tools.list_ports
 import esptool
-import subprocess
 import configparser
 
-CONDA_PYTHON = 'C:\\Users\\Pruvodky\\anaconda3\\envs\\newGWEnv\\python.exe'
+from esp_baud import BaudNegotiator, transfer_error
+from esp_bundle import BundleCache
+from esp_session import EspSession, parse_regions
 
 
 class UploadESP:
-	def __init__(self, log_signal, device):
+	def __init__(self, log_signal, device, progress=None):
 		self.device = device
 		self.log_signal = log_signal
+		self.progress = progress # progress(FlashProgress), throttled, called from the upload thread
 		self.esptool = esptool
+		self.esp = None
+		self.esp_mac = None
+		self.port_hwids = {}
+		self.baud_negotiator = BaudNegotiator()
+		self.transfer_error = False # the last program_esp failed in the serial transfer or MD5 check
+		self.bundle_cache = None
 		print('ESPTool: ', self.esptool)
 
 	def upload_esp_process(self):
 		self.log_signal.emit('Nahrávání ESP zahájeno', 'I')
 		if not self.load_config():
 			return False, 'Nepodařilo se načíst konfiguraci'
-		if not self.find_and_connect_esp():
-			return False, f'ESP nebylo nalezeno na portu: {self.port}'
-		if not self.erase_esp():
-			return False, 'ESP se nepodařilo smazat!'
-		time.sleep(5)
-		if not self.program_esp():
-			return False, 'Nahrávání ESP ne nezdařilo'
+		try:
+			if not self.find_and_connect_esp():
+				return False, f'ESP nebylo nalezeno na portu: {self.port}'
+			if not self.erase_esp():
+				return False, 'ESP se nepodařilo smazat!'
+			if not self.program_esp():
+				if self.baud_autotune and self.transfer_error:
+					# the link failed at the negotiated rate, the next board runs one step slower
+					self.baud_negotiator.step_down(self.hwid())
+				return False, 'Nahrávání ESP ne nezdařilo'
+		finally:
+			self.close_port(reset=self.after == 'hard_reset')
 
 		# 1. load config
 		# 2. find + connect to ESP 
@@ -44,6 +51,7 @@ class UploadESP:
 		ports = serial.tools.list_ports.comports()
 		for port, desc, hwid in sorted(ports):
 			print(f'Port: {port}, Desc: {desc}, HWID: {hwid}')
+			self.port_hwids[port] = hwid
 			if "USB Serial Port" in desc:
 				print('Port found: ', port)
 				return port
@@ -51,105 +59,85 @@ class UploadESP:
 		print("No matching ports found")
 		return False
 
+	def report_progress(self, progress):
+		if progress.done:
+			# one log line per written region instead of every esptool output line
+			self.log_signal.emit(f'Zapsáno {progress.region}: {progress.total // 1024} kB, {progress.rate / 1024:.0f} kB/s', 'I')
+		if self.progress:
+			self.progress(progress)
+
+	def hwid(self):
+		# the baud rate is remembered per USB serial adapter, the COM port number can change
+		return self.port_hwids.get(self.port, self.port)
+
 	def find_and_connect_esp(self):
+		# syncs and loads the stub once, erasing and programming continue on the same session
 		try:
 			new_port = self.get_ports()
 			if new_port:
 				print('New port found: ', new_port)
 				self.port = new_port
 
-			cmd = [CONDA_PYTHON, '-m', 'esptool', '--port', self.port, 'read_mac']
-			try:
-				result = subprocess.check_output(cmd, stderr=subprocess.STDOUT).decode()
-			except Exception as e:
-				print('Error while looking for ESP (subprocess.check_output): ', e)
-				return False
-				print('ESP found: ', result)
-
-			# extracting the mac and bluetooth
-			esp_mac = re.search(r'MAC: ([0-9a-fA-F:]+)', result)
-			print('ESP MAC: ', esp_mac)
-			if esp_mac:
-				esp_mac = esp_mac.group(1)
-			return True
-		
-		except subprocess.CalledProcessError as e:
-			print(f'Error while searching for ESP: {e.output.decode()}')
-			return False
+			self.esp = EspSession(self.port, self.baudrate, self.before, progress=self.report_progress).open()
+			self.esp_mac = self.esp.read_mac()
+			print('ESP MAC: ', self.esp_mac)
+			if self.baud_autotune:
+				self.baud_negotiator.negotiate(self.hwid(), self.esp)
+			return self.esp_mac
 
-		except Exception as e:
+		except (esptool.FatalError, serial.SerialException, OSError) as e:
 			print('Error while searching for ESP: ', e)
+			self.close_port(reset=False)
 			return False
 
 
 	def program_esp(self):
+		self.transfer_error = False
 		try:
-			#original_stderr = sys.stderr  # Save the original stderr
-			#custom_stderr = io.StringIO()
-
-			original_stdout = sys.stdout
-			sys.stdout = self
-
-			cmd = [
-				'--port', self.port,
-				'--baud', self.baudrate,
-				'--before', 'default_reset',
-				'--after', 'hard_reset',
-				'--chip', 'esp32',
-				'write_flash',
-				'--flash_mode', 'dio',
-				'--flash_freq', '40m',
-				'--flash_size', 'detect',
-				self.ptable_address, self.ptable_path,
-				self.ota_address, self.ota_path,
-				self.boot_address, self.boot_path,
-				self.app_address, self.app_path,
+			images = [
+				(self.ptable_address, self.ptable_path),
+				(self.ota_address, self.ota_path),
+				(self.boot_address, self.boot_path),
+				(self.app_address, self.app_path),
 			]
-
-			esptool.main(cmd)
-			#sys.stderr = original_stderr
-
-			#error_output = custom_stderr.getvalue()
+			if self.bundle_cache:
+				flash_size = self.esp.set_flash_size('detect')
+				bundle = self.bundle_cache.bundle(self.esp.esp, images, 'dio', '40m', flash_size)
+				self.esp.write_bundle(bundle)
+			else:
+				self.esp.write_flash(images, flash_mode='dio', flash_freq='40m', flash_size='detect')
 			return True
 		except Exception as e:
-			#sys.stderr = original_stderr
 			print('Error while programming ESP', e)
+			self.transfer_error = transfer_error(e)
 			return False
-		finally:
-			sys.stdout = original_stdout
 
 	def erase_esp(self):
 		try:
-			original_stdout = sys.stdout
-			sys.stdout = self
-			cmd = [
-				'--baud', self.baudrate,
-				'--port', self.port,
-				'erase_flash'
-			]
-			
-
-			esptool.main(cmd)
-			
+			if self.erase_mode == 'regions':
+				# the images are erased by the write, only the ranges that must end up blank are erased here
+				self.esp.erase_regions(self.blank_regions)
+			else:
+				# returns once the stub reports the chip erase as finished
+				self.esp.erase_flash()
 			return True
 		except Exception as e:
 			print(f'Error while erasing ESP: {e}')
-			
 			return False
-		finally:
-			sys.stdout = original_stdout
 	
-	def close_port(self):
-		
-			try:
-				if hasattr(self, 'serial_connection') and self.serial_connection:
-					self.serial_connection.close()
-					print(f'Port {self.port} closed successfully')
-				else:
-					print('There is no active connection to close')
-				
-			except Exception as e:
-				print(f'Error while closing port {self.port}: {e}')
+	def close_port(self, reset=True):
+		# hard reset starts the new firmware, then the port is released
+		try:
+			if self.esp:
+				self.esp.close(reset)
+				self.esp = None
+				print(f'Port {self.port} closed successfully')
+			else:
+				print('There is no active connection to close')
+
+		except Exception as e:
+			self.esp = None
+			print(f'Error while closing port {self.port}: {e}')
 
 
 	def load_config(self):
@@ -178,29 +166,20 @@ class UploadESP:
 		self.ptable_address = config['ESP']['Flash_Partition_Table_Address']
 		self.port = config['ESP']['COM_Port']
 		self.baudrate = config['ESP']['Baudrate']
-
-		return True
-	
-	@staticmethod
-	def remove_ansi(msg):
+		# no_reset for ports without DTR/RTS, e.g. esp_emulator.py
+		self.before = config['ESP'].get('Before', 'default_reset')
+		self.after = config['ESP'].get('After', 'hard_reset')
+		self.erase_mode = config['ESP'].get('Erase_Mode', 'chip').lower()
 		try:
-			ansi_escape = re.compile(r'\x18\[[0-9]*[ -/]*[@-~]')
-			return ansi_escape.sub('', msg)
-		except TypeError:
-			return msg
-	
-	def write(self, msg):
-		clear_msg = self.remove_ansi(msg)
-		if 'Writing at' and '%' in clear_msg:
-			self.log_signal.emit(clear_msg, 'I')
-
-		sys.__stdout__.write(clear_msg)
-
-	def isatty(self):
-		return False
-	
-	def flush(self):
-		pass
-
-
+			self.blank_regions = parse_regions(config['ESP'].get('Blank_Regions', ''))
+		except ValueError as e:
+			print('Invalid Blank_Regions: ', e)
+			return False
+		if config['ESP'].getboolean('Bundle_Cache', fallback=False):
+			self.bundle_cache = self.bundle_cache or BundleCache()
+		else:
+			self.bundle_cache = None
+		self.baud_autotune = config['ESP'].getboolean('Baud_Autotune', fallback=False)
+		self.baud_negotiator.max_baudrate = config['ESP'].getint('Max_Baudrate', fallback=self.baud_negotiator.max_baudrate)
 
+		return True
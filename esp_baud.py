@@ -0,0 +1,117 @@
+import re
+import json
+import hashlib
+import threading
+
+import esptool
+import serial
+
+CACHE_FILE = 'data/esp_baud.json'
+
+# baud rates tried after the stub is loaded, ascending
+SUPPORTED_BAUDRATES = [115200, 230400, 460800, 921600, 1500000, 2000000]
+
+# every rate has to read this block cleanly, the stub MD5 of the same range is the reference
+TEST_ADDRESS = 0x0
+TEST_SIZE = 0x4000
+
+# esptool errors of the serial link itself, a lower rate may avoid them
+TRANSFER_ERROR = re.compile(r'Timed out waiting for packet|Invalid head of packet|Packet content transfer stopped|Serial data stream stopped|MD5 of .* does not match')
+
+
+def transfer_error(error):
+	"""True for errors of the serial transfer or the MD5 check, not of the images or the chip"""
+	if isinstance(error, serial.SerialException):
+		return True
+	return isinstance(error, esptool.FatalError) and TRANSFER_ERROR.search(str(error)) is not None
+
+
+class BaudNegotiator:
+	"""Finds the fastest clean baud rate of a USB serial adapter and remembers it per HWID"""
+	def __init__(self, cache_file=CACHE_FILE, max_baudrate=SUPPORTED_BAUDRATES[-1]):
+		self.cache_file = cache_file
+		self.max_baudrate = int(max_baudrate)
+		self.lock = threading.Lock()
+		self.entries = {}
+		try:
+			with open(cache_file, 'r') as file:
+				self.entries = json.load(file)
+		except (OSError, ValueError):
+			pass
+
+	def baudrate(self, hwid):
+		entry = self.entries.get(hwid)
+		if entry:
+			return entry['baudrate']
+		return None
+
+	def negotiate(self, hwid, session):
+		"""Switches the stub session to the best rate, returns the rate in use"""
+		current = session.baudrate
+		cached = self.baudrate(hwid)
+		if cached:
+			if cached == current or self.try_baudrate(session, cached, current):
+				return cached
+			# the remembered rate does not work any more, search again from the current one
+			print(f'Remembered baud rate {cached} failed for {hwid}')
+
+		highest = current
+		try:
+			for baudrate in SUPPORTED_BAUDRATES:
+				if baudrate <= current or baudrate > self.max_baudrate:
+					continue
+				if not self.try_baudrate(session, baudrate, highest):
+					break
+				highest = baudrate
+		finally:
+			# kept even when the session could not be recovered, the rates below the failing one worked
+			print(f'ESP baud rate for {hwid}: {highest}')
+			self.store(hwid, highest)
+		return highest
+
+	def try_baudrate(self, session, baudrate, fallback):
+		"""Changes to baudrate and reads the test block, goes back to fallback if it is not clean"""
+		try:
+			session.change_baud(baudrate)
+			if self.test_block(session):
+				print(f'Baud rate {baudrate}: OK')
+				return True
+			print(f'Baud rate {baudrate}: corrupted test block')
+		except (esptool.FatalError, serial.SerialException, OSError) as e:
+			print(f'Baud rate {baudrate}: {e}')
+
+		try:
+			# the stub switches back with the old rate as the new one
+			session.change_baud(fallback)
+		except (esptool.FatalError, serial.SerialException, OSError) as e:
+			# the command did not get through at the failing rate, sync again from the ROM bootloader
+			print(f'Switching back to {fallback} failed: {e}, reconnecting')
+			session.reconnect(fallback)
+		return False
+
+	@staticmethod
+	def test_block(session):
+		data = session.esp.read_flash(TEST_ADDRESS, TEST_SIZE)
+		return hashlib.md5(data).hexdigest() == session.esp.flash_md5sum(TEST_ADDRESS, TEST_SIZE)
+
+	def step_down(self, hwid):
+		"""Called after a transfer or MD5 error, the next run uses the next lower rate"""
+		entry = self.entries.get(hwid)
+		if not entry or entry['baudrate'] not in SUPPORTED_BAUDRATES:
+			return None
+		index = SUPPORTED_BAUDRATES.index(entry['baudrate'])
+		if index == 0:
+			return entry['baudrate']
+		lower = SUPPORTED_BAUDRATES[index - 1]
+		print(f'ESP baud rate for {hwid} lowered to {lower}')
+		self.store(hwid, lower)
+		return lower
+
+	def store(self, hwid, baudrate):
+		with self.lock:
+			self.entries[hwid] = {'baudrate': baudrate}
+			try:
+				with open(self.cache_file, 'w') as file:
+					json.dump(self.entries, file, indent=4)
+			except OSError as e:
+				print('Error while saving ESP baud rate cache: ', e)
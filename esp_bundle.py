@@ -0,0 +1,116 @@
+import os
+import json
+import zlib
+import hashlib
+import argparse
+import threading
+
+import esptool.cmds
+
+from image_cache import ImageCache
+
+CACHE_DIR = 'data/esp_bundles'
+ERASED = 0xFF
+
+
+class EspBundle:
+	"""All ESP images merged into one flash image, stored compressed in stub sized blocks"""
+	def __init__(self, address, size, md5, blocks, block_sizes):
+		self.address = address
+		self.size = size # uncompressed
+		self.md5 = md5 # of the uncompressed image, compared with the stub flash_md5sum
+		self.blocks = blocks # compressed data, FLASH_WRITE_SIZE per block
+		self.block_sizes = block_sizes # uncompressed bytes produced by every block
+
+	@property
+	def compressed_size(self):
+		return sum(len(block) for block in self.blocks)
+
+	@classmethod
+	def build(cls, esp, images, flash_mode, flash_freq, flash_size):
+		"""images: [(address, path)], esp: loader of the target chip for the header patching"""
+		args = argparse.Namespace(chip=esp.CHIP_NAME.lower(), flash_mode=flash_mode, flash_freq=flash_freq, flash_size=flash_size)
+		parts = []
+		for address, path in sorted(images):
+			with open(path, 'rb') as file:
+				data = file.read()
+			# sets flash mode/frequency/size in the bootloader header the same way write_flash does
+			parts.append((address, esptool.cmds._update_image_flash_params(esp, address, args, data)))
+
+		start = parts[0][0]
+		merged = bytearray()
+		for address, data in parts:
+			offset = address - start
+			if offset < len(merged):
+				raise ValueError(f'Image at 0x{address:x} overlaps the previous one')
+			merged.extend(bytes([ERASED]) * (offset - len(merged)))
+			merged.extend(data)
+		# the stub writes whole words
+		merged.extend(bytes([ERASED]) * (-len(merged) % 4))
+
+		compressed = zlib.compress(bytes(merged), 9)
+		write_size = esp.FLASH_WRITE_SIZE
+		blocks = [compressed[i:i + write_size] for i in range(0, len(compressed), write_size)]
+		decompress = zlib.decompressobj()
+		block_sizes = [len(decompress.decompress(block)) for block in blocks]
+		return cls(start, len(merged), hashlib.md5(merged).hexdigest(), blocks, block_sizes)
+
+	def save(self, path):
+		with open(path + '.zz', 'wb') as file:
+			file.write(b''.join(self.blocks))
+		with open(path + '.json', 'w') as file:
+			json.dump({'address': self.address, 'size': self.size, 'md5': self.md5,
+				'block_sizes': self.block_sizes, 'block_size': len(self.blocks[0]) if self.blocks else 0}, file, indent=4)
+
+	@classmethod
+	def load(cls, path):
+		with open(path + '.json', 'r') as file:
+			info = json.load(file)
+		with open(path + '.zz', 'rb') as file:
+			compressed = file.read()
+		block_size = info['block_size']
+		blocks = [compressed[i:i + block_size] for i in range(0, len(compressed), block_size)]
+		if len(blocks) != len(info['block_sizes']):
+			raise ValueError(f'Bundle {path} is incomplete')
+		return cls(info['address'], info['size'], info['md5'], blocks, info['block_sizes'])
+
+
+class BundleCache:
+	"""Compressed bundles on disk, keyed by the hashes of the source images.
+
+	A bundle is only rebuilt when one of the .BIN files changes (new git
+	checkout) or the flash parameters differ.
+	"""
+	def __init__(self, cache_dir=CACHE_DIR, image_cache=None):
+		self.cache_dir = cache_dir
+		self.image_cache = image_cache or ImageCache()
+		self.lock = threading.Lock()
+		self.bundles = {}
+
+	def key(self, esp, images, flash_mode, flash_freq, flash_size):
+		key = hashlib.sha256(f'{esp.CHIP_NAME}:{esp.FLASH_WRITE_SIZE}:{flash_mode}:{flash_freq}:{flash_size}'.encode())
+		for address, path in sorted(images):
+			key.update(f'{address:x}:{self.image_cache.digest(path).md5}'.encode())
+		return key.hexdigest()[:32]
+
+	def bundle(self, esp, images, flash_mode, flash_freq, flash_size):
+		images = [(int(address, 0), path) for address, path in images]
+		key = self.key(esp, images, flash_mode, flash_freq, flash_size)
+		with self.lock:
+			if key in self.bundles:
+				return self.bundles[key]
+
+			path = os.path.join(self.cache_dir, key)
+			try:
+				bundle = EspBundle.load(path)
+			except (OSError, ValueError, KeyError):
+				print('Building ESP bundle ', key)
+				bundle = EspBundle.build(esp, images, flash_mode, flash_freq, flash_size)
+				try:
+					os.makedirs(self.cache_dir, exist_ok=True)
+					bundle.save(path)
+				except OSError as e:
+					print('Error while saving ESP bundle: ', e)
+
+			self.bundles[key] = bundle
+			return bundle
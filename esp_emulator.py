@@ -0,0 +1,341 @@
+"""ESP32 ROM bootloader and flasher stub stand-in on a Linux pseudo-terminal.
+
+Speaks the serial protocol esptool uses (SLIP framing, sync, registers, RAM
+download of the stub, flash erase/write/read and MD5) against an in-memory
+flash, so UploadESP can be benchmarked and regression tested without a board:
+
+	python esp_emulator.py --link /tmp/ttyESP --write-speed 200000
+	python -m esptool --port /tmp/ttyESP --before no_reset --after no_reset flash_id
+
+In config.ini set COM_Port to the link and Before/After = no_reset, a pty has
+no DTR/RTS lines to reset the chip with.
+"""
+import os
+import pty
+import tty
+import zlib
+import time
+import struct
+import select
+import hashlib
+import argparse
+
+# esptool command opcodes
+FLASH_BEGIN = 0x02
+FLASH_DATA = 0x03
+FLASH_END = 0x04
+MEM_BEGIN = 0x05
+MEM_END = 0x06
+MEM_DATA = 0x07
+SYNC = 0x08
+WRITE_REG = 0x09
+READ_REG = 0x0A
+SPI_SET_PARAMS = 0x0B
+SPI_ATTACH = 0x0D
+CHANGE_BAUDRATE = 0x0F
+FLASH_DEFL_BEGIN = 0x10
+FLASH_DEFL_DATA = 0x11
+FLASH_DEFL_END = 0x12
+SPI_FLASH_MD5 = 0x13
+GET_SECURITY_INFO = 0x14
+ERASE_FLASH = 0xD0
+ERASE_REGION = 0xD1
+READ_FLASH = 0xD2
+RUN_USER_CODE = 0xD3
+
+STUB_ONLY = (ERASE_FLASH, ERASE_REGION, READ_FLASH, RUN_USER_CODE)
+INVALID_MESSAGE = 0x05
+
+# ESP32 registers read by esptool
+CHIP_DETECT_MAGIC_REG = 0x40001000
+CHIP_DETECT_MAGIC_VALUE = 0x00F01D83
+EFUSE_BASE = 0x3FF5A000
+UART_CLKDIV_REG = 0x3FF40014
+SPI_BASE = 0x3FF42000
+SPI_CMD_REG = SPI_BASE + 0x00
+SPI_USR2_REG = SPI_BASE + 0x24
+SPI_W0_REG = SPI_BASE + 0x80
+SPI_CMD_USR = 1 << 18
+SPI_FLASH_RDID = 0x9F
+XTAL_FREQ = 40000000
+
+FLASH_ID = 0x1640EF # 4 MB
+FLASH_SIZE = 4 * 1024 * 1024
+ERASED = 0xFF
+
+
+class TimingModel:
+	"""Wire time at the current baud rate plus flash erase and write speeds in bytes per second"""
+	def __init__(self, baudrate=115200, erase_speed=100000, write_speed=200000):
+		self.baudrate = baudrate
+		self.erase_speed = erase_speed
+		self.write_speed = write_speed
+
+	def wire(self, size):
+		# 8N1, ten bit times per byte
+		time.sleep(size * 10 / self.baudrate)
+
+	def erase(self, size):
+		return size / self.erase_speed
+
+	def write(self, size):
+		return size / self.write_speed
+
+
+class EspEmulator:
+	def __init__(self, mac='24:0a:c4:00:00:01', timing=None, flash_size=FLASH_SIZE):
+		self.mac = bytes(int(part, 16) for part in mac.split(':'))
+		self.timing = timing or TimingModel()
+		self.flash = bytearray([ERASED]) * flash_size
+		self.registers = {}
+		self.stub = False
+		self.busy_until = 0 # the stub writes a flash block while the next one arrives
+		self.write = None # state of a running flash_begin/flash_defl_begin
+		self.initial_baudrate = self.timing.baudrate
+		self.master, slave = pty.openpty()
+		tty.setraw(slave)
+		self.port = os.ttyname(slave)
+		# closed again, reads fail with EIO while no client has the port open
+		os.close(slave)
+		self.connected = False
+		self.pending = bytearray()
+
+	# - - - SLIP - - -
+
+	def frames(self):
+		"""Complete SLIP frames received so far"""
+		while True:
+			start = self.pending.find(b'\xc0')
+			if start < 0:
+				self.pending.clear()
+				return
+			end = self.pending.find(b'\xc0', start + 1)
+			if end < 0:
+				del self.pending[:start]
+				return
+			frame = bytes(self.pending[start + 1:end])
+			del self.pending[:end]
+			if frame:
+				self.timing.wire(len(frame) + 2)
+				yield frame.replace(b'\xdb\xdc', b'\xc0').replace(b'\xdb\xdd', b'\xdb')
+
+	def send(self, packet):
+		frame = b'\xc0' + packet.replace(b'\xdb', b'\xdb\xdd').replace(b'\xc0', b'\xdb\xdc') + b'\xc0'
+		self.timing.wire(len(frame))
+		os.write(self.master, frame)
+
+	def respond(self, op, value=0, data=b'', error=0):
+		# the ESP32 ROM sends 4 status bytes, the stub 2
+		status = bytes([1 if error else 0, error]) + (b'' if self.stub else b'\x00\x00')
+		body = data + status
+		self.send(struct.pack('<BBHI', 1, op, len(body), value) + body)
+
+	# - - - commands - - -
+
+	def serve(self):
+		print(f'ESP32 emulator on {self.port}')
+		while True:
+			readable, _, _ = select.select([self.master], [], [], 1)
+			if not readable:
+				continue
+			try:
+				data = os.read(self.master, 4096)
+			except OSError:
+				# no client has the port open at the moment
+				self.connected = False
+				time.sleep(0.1)
+				continue
+			if not self.connected:
+				self.reset()
+			self.pending.extend(data)
+			for frame in self.frames():
+				if len(frame) < 8 or frame[0] != 0:
+					continue # read_flash acks and noise
+				_, op, size, checksum = struct.unpack('<BBHI', frame[:8])
+				self.command(op, frame[8:8 + size], checksum)
+
+	def reset(self):
+		"""Every new connection finds the chip freshly reset into the ROM bootloader, the flash is kept"""
+		print('Client connected, chip in download mode')
+		self.connected = True
+		self.stub = False
+		self.write = None
+		self.busy_until = 0
+		self.registers.clear()
+		self.pending.clear()
+		self.timing.baudrate = self.initial_baudrate
+
+	def command(self, op, data, checksum):
+		if op != FLASH_DEFL_DATA and op != FLASH_DATA:
+			self.wait_busy()
+		handler = {
+			SYNC: self.sync,
+			READ_REG: self.read_reg,
+			WRITE_REG: self.write_reg,
+			MEM_BEGIN: self.ok,
+			MEM_DATA: self.ok,
+			MEM_END: self.mem_end,
+			SPI_SET_PARAMS: self.ok,
+			SPI_ATTACH: self.ok,
+			CHANGE_BAUDRATE: self.change_baudrate,
+			FLASH_BEGIN: self.flash_begin,
+			FLASH_DATA: self.flash_data,
+			FLASH_END: self.ok,
+			FLASH_DEFL_BEGIN: self.flash_begin,
+			FLASH_DEFL_DATA: self.flash_data,
+			FLASH_DEFL_END: self.ok,
+			SPI_FLASH_MD5: self.md5,
+			ERASE_FLASH: self.erase_flash,
+			ERASE_REGION: self.erase_region,
+			READ_FLASH: self.read_flash,
+			RUN_USER_CODE: self.ok,
+		}.get(op)
+		if handler is None or (op in STUB_ONLY and not self.stub):
+			# GET_SECURITY_INFO included, the ESP32 ROM does not know it
+			self.respond(op, error=INVALID_MESSAGE)
+			return
+		handler(op, data)
+
+	def ok(self, op, data):
+		self.respond(op)
+
+	def wait_busy(self):
+		delay = self.busy_until - time.monotonic()
+		if delay > 0:
+			time.sleep(delay)
+
+	def sync(self, op, data):
+		# answered eight times, with a non zero value by the ROM and 0 by the stub
+		value = 0 if self.stub else 0x20120707
+		for _ in range(8):
+			self.respond(op, value)
+
+	def register(self, address):
+		if address == CHIP_DETECT_MAGIC_REG:
+			return CHIP_DETECT_MAGIC_VALUE
+		if address == EFUSE_BASE + 4:
+			return int.from_bytes(self.mac[2:6], 'big')
+		if address == EFUSE_BASE + 8:
+			return int.from_bytes(self.mac[0:2], 'big')
+		if address == UART_CLKDIV_REG:
+			return XTAL_FREQ // self.timing.baudrate
+		if address == SPI_CMD_REG:
+			return 0 # user commands finish immediately
+		return self.registers.get(address, 0)
+
+	def read_reg(self, op, data):
+		address, = struct.unpack('<I', data[:4])
+		self.respond(op, self.register(address))
+
+	def write_reg(self, op, data):
+		for offset in range(0, len(data) - 15, 16):
+			address, value, mask, _ = struct.unpack('<IIII', data[offset:offset + 16])
+			self.registers[address] = (self.registers.get(address, 0) & ~mask) | (value & mask)
+			if address == SPI_CMD_REG and value & SPI_CMD_USR:
+				self.spi_command()
+		self.respond(op)
+
+	def spi_command(self):
+		if self.registers.get(SPI_USR2_REG, 0) & 0xFF == SPI_FLASH_RDID:
+			self.registers[SPI_W0_REG] = FLASH_ID
+
+	def mem_end(self, op, data):
+		self.respond(op)
+		entry_flag, entry = struct.unpack('<II', data[:8])
+		if not entry_flag:
+			# the uploaded stub starts and greets the host
+			self.stub = True
+			self.send(b'OHAI')
+
+	def change_baudrate(self, op, data):
+		baudrate, _ = struct.unpack('<II', data[:8])
+		self.respond(op)
+		time.sleep(0.01)
+		self.timing.baudrate = baudrate
+
+	def flash_begin(self, op, data):
+		size, blocks, block_size, offset = struct.unpack('<IIII', data[:16])
+		self.write = {'offset': offset, 'position': offset, 'compressed': op == FLASH_DEFL_BEGIN,
+			'decompress': zlib.decompressobj()}
+		if size and not self.stub:
+			# the ROM erases the whole range before answering
+			time.sleep(self.timing.erase(size))
+			self.erase(offset, size)
+		self.respond(op)
+
+	def flash_data(self, op, data):
+		size, seq, _, _ = struct.unpack('<IIII', data[:16])
+		block = data[16:16 + size]
+		if self.write is None:
+			self.respond(op, error=INVALID_MESSAGE)
+			return
+		if self.write['compressed']:
+			block = self.write['decompress'].decompress(block)
+		position = self.write['position']
+		self.flash[position:position + len(block)] = block
+		self.write['position'] += len(block)
+
+		duration = self.timing.write(len(block))
+		if self.stub:
+			# acked on receipt, erased and written while the next block arrives
+			self.wait_busy()
+			self.respond(op)
+			self.busy_until = time.monotonic() + duration + self.timing.erase(len(block))
+		else:
+			time.sleep(duration)
+			self.respond(op)
+
+	def md5(self, op, data):
+		address, size, _, _ = struct.unpack('<IIII', data[:16])
+		digest = hashlib.md5(self.flash[address:address + size])
+		self.respond(op, data=digest.digest() if self.stub else digest.hexdigest().encode())
+
+	def erase(self, address, size):
+		self.flash[address:address + size] = bytes([ERASED]) * size
+
+	def erase_flash(self, op, data):
+		time.sleep(self.timing.erase(len(self.flash)))
+		self.erase(0, len(self.flash))
+		self.respond(op)
+
+	def erase_region(self, op, data):
+		address, size = struct.unpack('<II', data[:8])
+		time.sleep(self.timing.erase(size))
+		self.erase(address, size)
+		self.respond(op)
+
+	def read_flash(self, op, data):
+		address, size, packet_size, _ = struct.unpack('<IIII', data[:16])
+		self.respond(op)
+		content = bytes(self.flash[address:address + size])
+		for offset in range(0, size, packet_size):
+			self.send(content[offset:offset + packet_size])
+		self.send(hashlib.md5(content).digest())
+
+
+def main():
+	parser = argparse.ArgumentParser(description='ESP32 ROM/stub protocol emulator on a pty')
+	parser.add_argument('--link', help='symlink to the pty, usable as --port / COM_Port')
+	parser.add_argument('--mac', default='24:0a:c4:00:00:01')
+	parser.add_argument('--baud', type=int, default=115200, help='initial baud rate of the ROM')
+	parser.add_argument('--erase-speed', type=float, default=100000, help='bytes per second')
+	parser.add_argument('--write-speed', type=float, default=200000, help='bytes per second')
+	args = parser.parse_args()
+
+	emulator = EspEmulator(args.mac, TimingModel(args.baud, args.erase_speed, args.write_speed))
+	if args.link:
+		if os.path.islink(args.link):
+			os.remove(args.link)
+		os.symlink(emulator.port, args.link)
+		print(f'Linked {args.link} -> {emulator.port}')
+	try:
+		emulator.serve()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		if args.link and os.path.islink(args.link):
+			os.remove(args.link)
+
+
+if __name__ == '__main__':
+	main()
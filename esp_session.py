@@ -0,0 +1,141 @@
+import os
+import time
+import argparse
+import esptool
+import esptool.cmds
+
+from esptool.loader import DEFAULT_TIMEOUT, ERASE_WRITE_TIMEOUT_PER_MB, timeout_per_mb
+from esptool.util import flash_size_bytes
+
+from esp_bundle import EspBundle
+from flash_progress import ProgressReporter
+
+FLASH_SECTOR_SIZE = 0x1000
+
+
+def parse_regions(text):
+	"""'0x9000:0x5000, 0xd000:0x2000' -> [(0x9000, 0x5000), (0xd000, 0x2000)]"""
+	regions = []
+	for item in text.split(','):
+		item = item.strip()
+		if not item:
+			continue
+		address, size = (int(part, 0) for part in item.split(':'))
+		if address % FLASH_SECTOR_SIZE or size % FLASH_SECTOR_SIZE:
+			raise ValueError(f'Region {item} is not aligned to the 0x{FLASH_SECTOR_SIZE:x} byte flash sector')
+		regions.append((address, size))
+	return regions
+
+
+class EspSession:
+	"""One connection to the ESP ROM bootloader for the whole upload.
+
+	The reset/sync handshake and the flasher stub upload happen once in open(),
+	MAC read, erase and write then run on the same stub. Every operation returns
+	only after the stub has reported it as finished.
+	"""
+	def __init__(self, port, baudrate, connect_mode='default_reset', progress=None):
+		self.port = port
+		self.baudrate = int(baudrate)
+		self.connect_mode = connect_mode
+		self.progress = ProgressReporter(progress) # progress(FlashProgress) of every write
+		self.esp = None
+
+	def open(self):
+		# sync at the ROM baud rate, esptool does the same before switching to a faster one
+		initial_baud = min(esptool.ESPLoader.ESP_ROM_BAUD, self.baudrate)
+		rom = esptool.detect_chip(self.port, initial_baud, self.connect_mode)
+		self.esp = rom
+		try:
+			print('ESP found: ', rom.get_chip_description())
+			self.esp = rom.run_stub()
+			configured = self.baudrate
+			self.baudrate = initial_baud
+			if configured > initial_baud:
+				self.change_baud(configured)
+		except BaseException:
+			# the stub shares the port of the ROM loader, nobody else would close it
+			rom._port.close()
+			self.esp = None
+			raise
+		return self
+
+	def reconnect(self, baudrate):
+		"""Resets into the ROM bootloader and loads the stub again, for a link lost at a too high rate"""
+		self.close(reset=False)
+		self.baudrate = int(baudrate)
+		return self.open()
+
+	def change_baud(self, baudrate):
+		self.esp.change_baud(baudrate)
+		self.baudrate = baudrate
+
+	def read_mac(self):
+		mac = self.esp.read_mac()
+		return ':'.join(f'{byte:02x}' for byte in mac)
+
+	def erase_flash(self):
+		# the stub answers the erase command only after the whole chip is erased
+		esptool.cmds.erase_flash(self.esp, argparse.Namespace(force=False))
+
+	def erase_regions(self, regions):
+		"""Erases only the given (address, size) ranges.
+
+		The images themselves need no erase here, the stub erases the sectors
+		they cover before writing them.
+		"""
+		for address, size in regions:
+			print(f'Erasing region 0x{address:08x}-0x{address + size - 1:08x}')
+			self.esp.erase_region(address, size)
+
+	def set_flash_size(self, flash_size='detect'):
+		if flash_size == 'detect':
+			flash_size = esptool.cmds.detect_flash_size(self.esp) or '4MB'
+		self.esp.flash_set_parameters(flash_size_bytes(flash_size))
+		return flash_size
+
+	def write_flash(self, images, flash_mode='dio', flash_freq='40m', flash_size='detect'):
+		"""images: [(address, path)], every file written compressed and checked with the stub MD5"""
+		flash_size = self.set_flash_size(flash_size)
+		for address, path in sorted(images, key=lambda image: int(image[0], 0)):
+			bundle = EspBundle.build(self.esp, [(int(address, 0), path)], flash_mode, flash_freq, flash_size)
+			self.write_bundle(bundle, os.path.basename(path))
+
+	def write_bundle(self, bundle, region='ESP firmware'):
+		"""Streams the already compressed blocks of an EspBundle, then checks the stub MD5"""
+		esp = self.esp
+		start = time.time()
+		self.progress.start(region, bundle.size)
+		esp.flash_defl_begin(bundle.size, bundle.compressed_size, bundle.address)
+		timeout = DEFAULT_TIMEOUT
+		written = 0
+		for seq, (block, block_size) in enumerate(zip(bundle.blocks, bundle.block_sizes)):
+			esp.flash_defl_block(block, seq, timeout=timeout)
+			# the stub acks a block on receipt and writes it while the next one arrives
+			timeout = max(DEFAULT_TIMEOUT, timeout_per_mb(ERASE_WRITE_TIMEOUT_PER_MB, block_size))
+			written += block_size
+			if written < bundle.size:
+				self.progress.update(written)
+		# answered only after the last block is in flash
+		esp.read_reg(esp.CHIP_DETECT_MAGIC_REG_ADDR, timeout=timeout)
+		self.progress.update(bundle.size)
+		print('Wrote %d bytes (%d compressed) at 0x%08x in %.1f seconds'
+			% (bundle.size, bundle.compressed_size, bundle.address, time.time() - start))
+
+		md5 = esp.flash_md5sum(bundle.address, bundle.size)
+		if md5 != bundle.md5:
+			raise esptool.FatalError(f'MD5 of {region} {bundle.md5} does not match data in flash {md5}')
+		print('Hash of data verified.')
+		# leave the compressed flash mode without running the application
+		esp.flash_begin(0, 0)
+		esp.flash_defl_finish(False)
+
+	def close(self, reset=True):
+		if not self.esp:
+			return
+		try:
+			if reset:
+				self.esp.hard_reset()
+		finally:
+			self.esp._port.close()
+			self.esp = None
@@ -0,0 +1,224 @@
+import time
+import queue
+import threading
+import itertools
+import multiprocessing
+import concurrent.futures
+
+# seconds a single job may run before its worker is considered hung
+JOB_TIMEOUT = 600
+# a crashed worker is started again at most this often
+RESTART_DELAY = 2
+# how often the monitor polls the workers when there is nothing to do
+POLL_INTERVAL = 0.05
+
+
+class FlashJob:
+	"""One flashing job handed to a worker process, kind is 'esp' or 'stm'"""
+	def __init__(self, kind, device, options=None):
+		self.job_id = None
+		self.kind = kind
+		self.device = device
+		self.options = options or {} # keyword arguments of UploadSTM / UploadESP
+
+	def __repr__(self):
+		return f'FlashJob({self.job_id}, {self.kind}, {self.device})'
+
+
+class FlashEvent:
+	"""Sent from a worker process back to the GUI process.
+
+	kind: 'started', 'log' (message, type), 'progress' (percent, text) or
+	'result' (result, info, extra)
+	"""
+	def __init__(self, job_id, kind, *data):
+		self.job_id = job_id
+		self.kind = kind
+		self.data = data
+
+	def __repr__(self):
+		return f'FlashEvent({self.job_id}, {self.kind}, {self.data})'
+
+
+class QueueLogSignal:
+	"""Stands in for the Qt log_signal inside a worker process"""
+	def __init__(self, events, job_id):
+		self.events = events
+		self.job_id = job_id
+
+	def emit(self, msg, type='I'):
+		self.events.put(FlashEvent(self.job_id, 'log', msg, type))
+
+
+def run_job(job, events):
+	# imported here so the GUI process does not need the flashing modules loaded for the pool
+	if job.kind == 'esp':
+		from esp import UploadESP
+		esp = UploadESP(QueueLogSignal(events, job.job_id), job.device,
+			progress=lambda progress: events.put(FlashEvent(job.job_id, 'progress', progress.percent, str(progress))))
+		result, info = esp.upload_esp_process()
+		return result, info, {'esp_mac': esp.esp_mac}
+
+	if job.kind == 'stm':
+		from stm import UploadSTM
+		stm = UploadSTM(job.device, progress=lambda step: events.put(FlashEvent(job.job_id, 'progress', None, step)), **job.options)
+		result, info = stm.upload_stm()
+		return result, info, {}
+
+	return False, f'Unknown job kind: {job.kind}', {}
+
+
+def worker_main(jobs, events):
+	"""Entry point of a worker process, runs jobs until it receives None"""
+	while True:
+		job = jobs.get()
+		if job is None:
+			break
+		events.put(FlashEvent(job.job_id, 'started'))
+		try:
+			result, info, extra = run_job(job, events)
+		except Exception as e:
+			result, info, extra = False, f'Unexpected error: {e}', {}
+		events.put(FlashEvent(job.job_id, 'result', result, info, extra))
+
+
+class FlashWorker:
+	def __init__(self, context):
+		# own queues per worker, a terminated worker cannot leave a shared queue locked
+		self.jobs = context.Queue()
+		self.events = context.Queue()
+		self.process = context.Process(target=worker_main, args=(self.jobs, self.events), daemon=True)
+		self.process.start()
+		self.created = time.monotonic()
+		self.job = None
+		self.started = None
+
+	@property
+	def idle(self):
+		return self.job is None
+
+
+class FlashWorkerPool:
+	"""Worker processes that are started before the boards arrive and run flashing jobs.
+
+	submit() returns a concurrent.futures.Future with (result, info, extra).
+	on_event(FlashEvent) is called from the monitor thread for every log and
+	progress event. A worker that dies or exceeds job_timeout is terminated,
+	its job fails and a new worker takes its place.
+	"""
+	def __init__(self, processes=2, job_timeout=JOB_TIMEOUT, on_event=None):
+		# spawn like on Windows, a forked GUI process is not safe to run jobs in
+		self.context = multiprocessing.get_context('spawn')
+		self.processes = processes
+		self.job_timeout = job_timeout
+		self.on_event = on_event
+		self.workers = []
+		self.pending = queue.Queue()
+		self.futures = {}
+		self.job_ids = itertools.count(1)
+		self.lock = threading.Lock()
+		self.running = False
+		self.monitor = None
+
+	def start(self):
+		with self.lock:
+			self.workers = [FlashWorker(self.context) for _ in range(self.processes)]
+			self.running = True
+		self.monitor = threading.Thread(target=self.monitor_workers, daemon=True)
+		self.monitor.start()
+		print(f'Flash worker pool started with {self.processes} processes')
+
+	def submit(self, job):
+		future = concurrent.futures.Future()
+		with self.lock:
+			job.job_id = next(self.job_ids)
+			self.futures[job.job_id] = future
+		self.pending.put(job)
+		return future
+
+	def stop(self):
+		with self.lock:
+			self.running = False
+			workers = list(self.workers)
+		for worker in workers:
+			worker.jobs.put(None)
+		for worker in workers:
+			worker.process.join(timeout=2)
+			if worker.process.is_alive():
+				worker.process.terminate()
+		if self.monitor:
+			self.monitor.join(timeout=2)
+
+	def monitor_workers(self):
+		while self.running:
+			self.dispatch()
+			events = self.collect_events()
+			for event in events:
+				self.handle_event(event)
+			self.check_workers()
+			if not events:
+				time.sleep(POLL_INTERVAL)
+
+	def collect_events(self):
+		with self.lock:
+			workers = list(self.workers)
+		events = []
+		for worker in workers:
+			while True:
+				try:
+					events.append(worker.events.get_nowait())
+				except queue.Empty:
+					break
+		return events
+
+	def dispatch(self):
+		with self.lock:
+			for worker in self.workers:
+				if not worker.idle or not worker.process.is_alive():
+					continue
+				try:
+					job = self.pending.get_nowait()
+				except queue.Empty:
+					return
+				worker.job = job
+				worker.started = time.monotonic()
+				worker.jobs.put(job)
+
+	def handle_event(self, event):
+		if event.kind == 'result':
+			with self.lock:
+				for worker in self.workers:
+					if worker.job and worker.job.job_id == event.job_id:
+						worker.job = None
+			self.finish(event.job_id, event.data)
+		elif self.on_event:
+			self.on_event(event)
+
+	def check_workers(self):
+		with self.lock:
+			if not self.running:
+				return
+			for index, worker in enumerate(self.workers):
+				crashed = not worker.process.is_alive()
+				hung = worker.job and time.monotonic() - worker.started > self.job_timeout
+				if not crashed and not hung:
+					continue
+
+				job = worker.job
+				worker.job = None
+				reason = 'worker process crashed' if crashed else f'no result within {self.job_timeout} s'
+				if job:
+					self.finish(job.job_id, (False, f'Flashing failed, {reason}', {}))
+				if crashed and time.monotonic() - worker.created < RESTART_DELAY:
+					# keeps a worker that dies on start from being restarted in a loop
+					continue
+				print(f'Flash worker {worker.process.pid}: {reason}, restarting')
+				if not crashed:
+					worker.process.terminate()
+				worker.process.join(timeout=2)
+				self.workers[index] = FlashWorker(self.context)
+
+	def finish(self, job_id, data):
+		future = self.futures.pop(job_id, None)
+		if future and not future.done():
+			future.set_result(tuple(data))
@@ -0,0 +1,65 @@
+import time
+import threading
+
+# updates per second handed to the GUI at most
+UPDATE_RATE = 10
+
+
+class FlashProgress:
+	"""State of one write: bytes written out of total in a region, rate in bytes per second"""
+	def __init__(self, region, written, total, rate):
+		self.region = region
+		self.written = written
+		self.total = total
+		self.rate = rate
+
+	@property
+	def percent(self):
+		if not self.total:
+			return 100
+		return min(100, 100 * self.written // self.total)
+
+	@property
+	def done(self):
+		return self.written >= self.total
+
+	def __str__(self):
+		return f'{self.region}: {self.written}/{self.total} B ({self.percent} %, {self.rate / 1024:.1f} kB/s)'
+
+
+class ProgressReporter:
+	"""Turns byte counts of a write into FlashProgress events for callback.
+
+	Events are throttled to UPDATE_RATE per second, the first and the last
+	event of every region are always delivered.
+	"""
+	def __init__(self, callback=None, update_rate=UPDATE_RATE):
+		self.callback = callback
+		self.interval = 1 / update_rate
+		self.lock = threading.Lock()
+		self.region = None
+		self.total = 0
+		self.started = 0
+		self.last_report = 0
+
+	def start(self, region, total):
+		with self.lock:
+			self.region = region
+			self.total = total
+			self.started = time.monotonic()
+			self.last_report = 0
+		self.update(0)
+
+	def update(self, written):
+		if not self.callback:
+			return
+		with self.lock:
+			now = time.monotonic()
+			final = written >= self.total
+			if not final and written and now - self.last_report < self.interval:
+				return
+			self.last_report = now
+			elapsed = now - self.started
+			rate = written / elapsed if elapsed > 0 else 0
+			event = FlashProgress(self.region, written, self.total, rate)
+		self.callback(event)
@@ -1,8 +1,11 @@
 import os
 import stat
 import shutil
+import asyncio
 import subprocess
 
+from async_io import run_process
+
 class GitClone:
 	def __init__(self, url, clone_dir, working_dir):
 		self.url = url
@@ -18,11 +21,7 @@ class GitClone:
 	
 	def clone(self):
 		# first check the path and delete previous clone
-		self.change_permissions(self.clone_dir)
-		if os.path.exists(self.working_dir):
-			shutil.rmtree(self.working_dir)
-
-		os.makedirs(self.working_dir, exist_ok=True)
+		self.prepare()
 		# clone the repository
 		try:
 			subprocess.run(['git', 'clone', self.url, self.working_dir])
@@ -31,6 +30,28 @@ class GitClone:
 		except Exception as e:
 			print(f'[ERROR] while cloning repository: {e}')
 
+	async def clone_async(self, timeout=None):
+		"""clone() on the asyncio loop, git is killed on timeout or when the stage is cancelled"""
+		# deleting the old checkout is plain file system work, it runs in a thread
+		await asyncio.to_thread(self.prepare)
+		try:
+			returncode, _ = await run_process(['git', 'clone', self.url, self.working_dir], timeout,
+				on_line=lambda line: print(f'[GIT] {line}'))
+		except OSError as e:
+			print(f'[ERROR] while cloning repository: {e}')
+			return False
+		if returncode != 0:
+			print(f'[ERROR] git clone exited with {returncode}')
+			return False
+		print(f'[INFO] Repository cloned to {self.working_dir}')
+		return True
+
+	def prepare(self):
+		self.change_permissions(self.clone_dir)
+		if os.path.exists(self.working_dir):
+			shutil.rmtree(self.working_dir)
+		os.makedirs(self.working_dir, exist_ok=True)
+
 # test it
 
 # url = 'http://192.168.1.127/assemblyline/gw100_gw10_assemblyline.git'
@@ -0,0 +1,59 @@
+import os
+import json
+import zlib
+import hashlib
+import threading
+
+CACHE_FILE = 'data/image_cache.json'
+
+
+class ImageDigest:
+	"""Checksums of one firmware image"""
+	def __init__(self, path, size, crc32, md5):
+		self.path = path
+		self.size = size
+		self.crc32 = crc32
+		self.md5 = md5
+
+	@classmethod
+	def from_data(cls, path, data):
+		return cls(path, len(data), zlib.crc32(data), hashlib.md5(data).hexdigest())
+
+	def to_dict(self):
+		return {'size': self.size, 'crc32': self.crc32, 'md5': self.md5}
+
+
+class ImageCache:
+	"""Digests of the .BIN files, only recomputed when a file changes on disk"""
+	def __init__(self, cache_file=CACHE_FILE):
+		self.cache_file = cache_file
+		self.lock = threading.Lock()
+		self.entries = {}
+		try:
+			with open(cache_file, 'r') as file:
+				self.entries = json.load(file)
+		except (OSError, ValueError):
+			pass
+
+	def digest(self, path):
+		path = os.path.abspath(path)
+		stat = os.stat(path)
+		key = f'{stat.st_size}:{stat.st_mtime_ns}'
+
+		with self.lock:
+			entry = self.entries.get(path)
+			if entry and entry.get('key') == key:
+				return ImageDigest(path, entry['size'], entry['crc32'], entry['md5'])
+
+			with open(path, 'rb') as file:
+				digest = ImageDigest.from_data(path, file.read())
+			self.entries[path] = dict(digest.to_dict(), key=key)
+			self.save()
+			return digest
+
+	def save(self):
+		try:
+			with open(self.cache_file, 'w') as file:
+				json.dump(self.entries, file, indent=4)
+		except OSError as e:
+			print('Error while saving image cache: ', e)
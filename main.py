@@ -1,8 +1,11 @@
 import sys
 import time
 import json
+import asyncio
 import serial
 import datetime
+import configparser
+import concurrent.futures
 import serial.tools.list_ports
 
 from PyQt6.QtWidgets import *
@@ -11,10 +14,13 @@ from PyQt6.QtGui import *
 
 
 from login import LoginWindow
-from rf import SerialConnection, RfUSBControl
-from psu import PSUControll
+from rf import SerialConnection, RfUSBControl, START_BUTTON, BOARD_INSERTED
+from psu import PSUControll, AsyncPSUControll
+from async_io import async_enabled, stage_timeout
 from esp import UploadESP
 from stm import UploadSTM
+from flash_pool import FlashWorkerPool, FlashJob, JOB_TIMEOUT
+from boot_console import BootConsole
 from git_clone import GitClone
 from data_saver import DataSaver
 
@@ -53,6 +59,9 @@ class ServiceWidget(QWidget):
 	change_signal = pyqtSignal()
 	save_signal = pyqtSignal()
 	close_signal = pyqtSignal()
+	esp_mac_signal = pyqtSignal(str)
+	progress_signal = pyqtSignal(int)
+	tester_signal = pyqtSignal(object)
 
 	def __init__(self, username, role, device):
 		super().__init__()
@@ -67,9 +76,28 @@ class ServiceWidget(QWidget):
 		self.change_signal.connect(self.change_device)
 		self.save_signal.connect(self.save_data)
 		self.close_signal.connect(self.close_app)
-
-		self.psu = PSUControll()
-		self.rf_control = RfUSBControl() # init the class at the beginning
+		self.esp_mac_signal.connect(self.show_esp_mac)
+		self.progress_signal.connect(self.progress_bar_value)
+		# emitted from the tester listener thread, queued so the listener never waits for the GUI
+		self.tester_signal.connect(self.tester_event, Qt.ConnectionType.QueuedConnection)
+
+		# with [ASYNC] Enabled the GUI runs on a qasync loop, ported stages run on it as coroutines
+		self.loop = asyncio.get_event_loop() if async_enabled() else None
+		self.stage_timeout = stage_timeout()
+		self.stage_tasks = set()
+		self.psu = AsyncPSUControll(self.loop) if self.loop else PSUControll()
+		tester = self.tester_config()
+		self.rf_control = RfUSBControl(tester.getboolean('Ack_Commands', fallback=False), tester.getboolean('Packed_Commands', fallback=False)) # init the class at the beginning
+		self.rework = None # True when repeating the process, None = Rework_Mode from config.ini
+		self.concurrent_results = {} # {'esp': bool, 'stm': bool} of the last concurrent upload
+		self.flash_pool = self.start_flash_pool() # None = flashing runs in this process
+		self.boot_result = None # ConsoleResult of the last boot after programming
+		self.cycle_running = False # from START until the result is shown, tester events are ignored meanwhile
+		self.board_inserted = False # reported by the tester, the operator is not asked again
+		self.auto_start = tester.getboolean('Auto_Start', fallback=False)
+		if self.auto_start:
+			self.rf_control.events.subscribe(START_BUTTON, self.tester_signal.emit)
+			self.rf_control.events.subscribe(BOARD_INSERTED, self.tester_signal.emit)
 
 # -------------------- FONT SETUP --------------------
 		font = QFont()
@@ -318,7 +346,10 @@ class ServiceWidget(QWidget):
 			self.log_signal.emit('<b>Nepodařilo se připojit k testeru, zkontrolujte, zda je vše zapojeno a zkuste to znovu!</b>', 'E')
 			return
 		
+		self.cycle_running = True
 		self.erase_gui()
+		self.rework = None
+		self.boot_result = None
 		
 		mac = self.generate_mac()
 		if not mac:
@@ -342,11 +373,15 @@ class ServiceWidget(QWidget):
 			self.log_signal.emit('ID desky nebylo načteno nebo neodpovídá požadovanému formátu!', 'W')
 			return False
 
-		result = self.confirmation_msg('Informace', 'Je deska v testeru?')
-		print('Result: ', result)
-		if not result:
-			self.switch_leds(False)
-			return
+		if self.board_inserted:
+			self.log_signal.emit('Deska je v testeru.', 'I')
+		else:
+			result = self.confirmation_msg('Informace', 'Je deska v testeru?')
+			print('Result: ', result)
+			if not result:
+				self.switch_leds(False)
+				return
+		self.board_inserted = False
 		
 		self.ready_to_upload_check.setChecked(True)
 
@@ -355,11 +390,15 @@ class ServiceWidget(QWidget):
 
 	def try_again(self):
 		
-		if not self.mac.text() or not self.protocol_number or not self.desk_id():
+		if not self.mac.text() or not self.protocol_number or not self.desk_id.text():
 			self.log_signal.emit('<b>Některe parametry chybí, použijte tlačítko START. </b>', 'E')
 			return
 
 		self.log_signal.emit('Proces bude zopakován', 'I')
+		# the board was already programmed once, only changed STM regions are uploaded again
+		self.rework = True
+		self.cycle_running = True
+		self.boot_result = None
 		self.start_background_worker()
 
 	def start_background_worker(self):
@@ -367,8 +406,7 @@ class ServiceWidget(QWidget):
 		self.log_signal.emit('<b>ZAČÍNÁ NAHRÁVÁNÍ</b',)
 		self.log_signal.emit('------------------------------------------')
 
-		self.rf_control.set_aux_blinking(2, 100)
-		self.rf_control.set_aux_blinking(1, 100)
+		self.rf_control.execute([self.rf_control.blink_payload(2, 100), self.rf_control.blink_payload(1, 100)])
 
 		'''
 		- always check if the specific checkbox is checked before starting the actual process
@@ -382,6 +420,8 @@ class ServiceWidget(QWidget):
 
 		if not self.psu_connected_check.isChecked():
 			self.init_psu()
+		elif not self.esp_uploaded_check.isChecked() and not self.stm_uploaded_check.isChecked() and self.concurrent_upload():
+			self.upload_concurrent()
 		elif not self.esp_uploaded_check.isChecked():
 			self.upload_esp()
 		elif not self.stm_uploaded_check.isChecked():
@@ -396,22 +436,27 @@ class ServiceWidget(QWidget):
 	def init_psu(self):
 		self.log_signal.emit('1 z 5 - <b>Inicializace zdroje</b>', 'I')
 		print('Init PSU')
+		if self.loop:
+			self.run_stage(self.init_psu_async(), self.init_psu_done)
+			return
 		self.rf_control.set_aux_pin(4,0) # vypnuti ESP
 		worker = Worker(self.init_psu_worker)
 		worker.signals.result.connect(self.init_psu_done)
 		QThreadPool.globalInstance().start(worker)
 
+	async def init_psu_async(self):
+		if not await self.rf_control.set_aux_pins_async([(4, 0)]): # vypnuti ESP
+			return False
+		if not await self.psu.start_psu_async(PSU_IP):
+			return False
+		return await self.rf_control.set_aux_pins_async([(1, 0), (3, 1)], spacing=0.1)
+
 	def init_psu_worker(self):
 		print('Init PSU Worker')
 		if not self.psu.start_psu(PSU_IP):
 			return False
-		if not self.rf_control.set_aux_pin(1,0):
-			return False
-		time.sleep(0.1)
-		if not self.rf_control.set_aux_pin(3,1):
-			return False
-		time.sleep(0.1)
-		return True
+		# with ACKs it returns once the tester has switched both pins, otherwise after 0.1 s per pin
+		return self.rf_control.set_aux_pins([(1, 0), (3, 1)], spacing=0.1)
 
 	def init_psu_done(self, result):
 		if not result:
@@ -432,16 +477,30 @@ class ServiceWidget(QWidget):
 		worker.signals.result.connect(self.upload_esp_done)
 		QThreadPool.globalInstance().start(worker)
 
-	def upload_esp_worker(self):
+	def upload_esp_worker(self, release_pins=True):
 		try:
 			# init ESP class to be able to call upload_esp_process
 			if not self.rf_control.set_aux_pin(4, 1):
 				return False
-			esp = UploadESP(log_signal=self.log_signal, device=self.device)
-			result, info = esp.upload_esp_process() # process that loads config, connects to esp, reases esp and programs esp
+			if self.flash_pool:
+				result, info, extra = self.flash_pool.submit(FlashJob('esp', self.device)).result()
+				esp_mac = extra.get('esp_mac')
+			else:
+				esp = UploadESP(log_signal=self.log_signal, device=self.device, progress=lambda progress: self.progress_signal.emit(progress.percent))
+				result, info = esp.upload_esp_process() # process that loads config, connects to esp, reases esp and programs esp
+				esp_mac = esp.esp_mac
+			if esp_mac:
+				self.esp_mac_signal.emit(esp_mac)
 			# reset pins after done, no matter the result
-			self.rf_control.reset_pin(4, 1, 2)
-			time.sleep(0.5)
+			# concurrently the STM is still being programmed, release_esp_pins runs once both are done
+			if release_pins:
+				console = BootConsole.from_config()
+				if console:
+					# check_boot power cycles the board again and waits for the console, a short pulse is enough
+					self.rf_control.reset_pin(4, 1, console.power_off_time)
+				else:
+					self.rf_control.reset_pin(4, 1, 2)
+					time.sleep(0.5)
 			if result:
 				return True
 			else:
@@ -456,11 +515,37 @@ class ServiceWidget(QWidget):
 
 		finally:
 		# always reset set these pins at the end
-			self.rf_control.set_aux_pin(4, 0)
-			time.sleep(2)
-			self.rf_control.set_aux_pin(3, 0)
-			time.sleep(2)
+			if release_pins:
+				self.release_esp_pins()
+
+	def release_esp_pins(self):
+		# with the console check the board is power cycled again in check_boot, the pauses can be short
+		console = BootConsole.from_config()
+		self.rf_control.set_aux_pins([(4, 0), (3, 0)], spacing=console.power_off_time if console else 2)
+		self.rf_control.set_aux_pin(4, 1)
+
+	def check_boot(self):
+		# runs once both chips are programmed, the console decides when the board is up
+		console = BootConsole.from_config()
+		if not console:
+			return
+
+		self.rf_control.set_aux_pin(4, 0)
+		time.sleep(console.power_off_time)
+		try:
+			console.start()
+		except (serial.SerialException, OSError) as e:
+			print('Error while opening the console port: ', e)
 			self.rf_control.set_aux_pin(4, 1)
+			return
+		self.rf_control.set_aux_pin(4, 1)
+		self.boot_result = console.wait()
+		print('Boot check: ', self.boot_result)
+		if not self.boot_result.passed:
+			print('Console output: ', '\n'.join(self.boot_result.lines[-20:]))
+
+	def show_esp_mac(self, esp_mac):
+		self.esp_mac.setText(esp_mac)
 
 	def upload_esp_done(self, result):
 		if not result:
@@ -476,20 +561,21 @@ class ServiceWidget(QWidget):
 	def upload_stm(self):
 		# first set corespondig voltage and current (basically turn on the psu)
 		self.log_signal.emit('3 z 5 - <b>Nahrávání ST čipu</b>', 'I')
-		self.psu.set_volt_curr(1, 14, 0.5)
-		self.psu.set_volt_curr(2, 8.3, 0.5)
+		self.upload_power_then(self.upload_stm_worker, self.upload_stm_done)
 
-		worker = Worker(self.upload_stm_worker)
-		worker.signals.result.connect(self.upload_stm_done)
-		QThreadPool.globalInstance().start(worker)
-
-	def upload_stm_worker(self):
-		self.stm = UploadSTM(self.device)
-		result, info = self.stm.upload_stm()
+	def upload_stm_worker(self, check_boot=True):
+		if self.flash_pool:
+			result, info, _ = self.flash_pool.submit(FlashJob('stm', self.device, {'rework': self.rework})).result()
+		else:
+			self.stm = UploadSTM(self.device, rework=self.rework)
+			result, info = self.stm.upload_stm()
 		if not result:
 			print('Result: ', result, 'Info: ', info)
 			self.log_signal.emit(f'Nahrávání STM se nezdařilo: <b>{info}</b>', 'E')
 			return False
+		if check_boot:
+			# the ESP was programmed in the previous stage
+			self.check_boot()
 		return True
 
 	def upload_stm_done(self, result):
@@ -501,6 +587,96 @@ class ServiceWidget(QWidget):
 		self.stm_uploaded_check.setChecked(True)
 		self.start_background_worker()
 
+	# 2 + 3
+	def concurrent_upload(self):
+		config = configparser.ConfigParser()
+		config.read('config.ini')
+		return config.getboolean('UPLOAD', 'Concurrent', fallback=False)
+
+	def start_flash_pool(self):
+		config = configparser.ConfigParser()
+		config.read('config.ini')
+		processes = config.getint('UPLOAD', 'Worker_Processes', fallback=0)
+		if processes <= 0:
+			return None
+		pool = FlashWorkerPool(processes, config.getint('UPLOAD', 'Job_Timeout', fallback=JOB_TIMEOUT), self.flash_event)
+		pool.start()
+		return pool
+
+	def flash_event(self, event):
+		# called from the pool monitor thread, only signals are used here
+		if event.kind == 'log':
+			self.log_signal.emit(*event.data)
+		elif event.kind == 'progress':
+			percent, text = event.data
+			if percent is not None:
+				self.progress_signal.emit(percent)
+			print(f'[INFO] Job {event.job_id}: {text}')
+
+	def upload_concurrent(self):
+		# ESP over the USB UART and STM over SWD are independent, both run once the PSU is up
+		self.log_signal.emit('2+3 z 5 - <b>Nahrávání ESP a ST čipu současně</b>', 'I')
+		self.upload_power_then(self.upload_concurrent_worker, self.upload_concurrent_done)
+
+	def upload_power_then(self, worker_fn, done_fn):
+		# main power and battery for programming, then the upload itself in the thread pool
+		if not self.loop:
+			self.psu.set_volt_curr(1, 14, 0.5)
+			self.psu.set_volt_curr(2, 8.3, 0.5)
+			self.start_worker(worker_fn, done_fn)
+			return
+		self.run_stage(self.upload_power_async(), lambda result: self.upload_power_done(result, worker_fn, done_fn))
+
+	async def upload_power_async(self):
+		# both channels settle at the same time
+		results = await asyncio.gather(self.psu.set_volt_curr_async(1, 14, 0.5), self.psu.set_volt_curr_async(2, 8.3, 0.5))
+		return all(results)
+
+	def upload_power_done(self, result, worker_fn, done_fn):
+		if not result:
+			self.log_signal.emit('Nepodařilo se nastavit napájení desky!', 'E')
+			self.switch_leds(False)
+			return
+		self.start_worker(worker_fn, done_fn)
+
+	def start_worker(self, worker_fn, done_fn):
+		worker = Worker(worker_fn)
+		worker.signals.result.connect(done_fn)
+		QThreadPool.globalInstance().start(worker)
+
+	def upload_concurrent_worker(self):
+		with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+			# the ESP pin reset sequence toggles aux pin 3, so it runs only after the STM is done as well
+			esp_future = executor.submit(self.upload_esp_worker, False)
+			stm_future = executor.submit(self.upload_stm_worker, False)
+			results = {}
+			for name, future in (('esp', esp_future), ('stm', stm_future)):
+				try:
+					results[name] = bool(future.result())
+				except Exception as e:
+					print(f'Error in concurrent {name} upload: ', e)
+					results[name] = False
+		self.release_esp_pins()
+		if all(results.values()):
+			self.check_boot()
+		self.concurrent_results = results
+		return all(results.values())
+
+	def upload_concurrent_done(self, result):
+		results = self.concurrent_results
+		self.esp_uploaded_check.setChecked(results['esp'])
+		self.stm_uploaded_check.setChecked(results['stm'])
+		if not result:
+			self.switch_leds(False)
+			if not results['esp']:
+				self.psu_connected_check.setChecked(False)
+				self.log_signal.emit('Nepodařilo se nahrát čip ESP!', 'W')
+			if not results['stm']:
+				self.log_signal.emit('Nepodařilo se nahrát čip ST!', 'W')
+			return False
+
+		self.start_background_worker()
+
 	# 4
 	def psu_measuring(self):
 		self.log_signal.emit('4 z 5 - <b>Měření desky</b>', 'I')
@@ -530,7 +706,16 @@ class ServiceWidget(QWidget):
 	# 5
 	def work_finished(self):
 		self.log_signal.emit('5 z 5 - <b>Rozsvícení desky</b>', 'I')
-		result = self.confirmation_msg('Potvrzení', 'Svítí display a je vidět text?')
+		if self.boot_result and self.boot_result.board_ready:
+			self.log_signal.emit(f'Deska nabootovala ({self.boot_result.reason}).', 'O')
+			result = True
+		else:
+			if self.boot_result and self.boot_result.passed:
+				self.log_signal.emit(f'ESP nabootovalo ({self.boot_result.reason}), STM a display potvrďte ručně.', 'I')
+			elif self.boot_result:
+				self.log_signal.emit(f'Kontrola bootu se nezdařila: {self.boot_result.reason}', 'W')
+			# manual check when the console capture is off, inconclusive or has no STM and display markers
+			result = self.confirmation_msg('Potvrzení', 'Svítí display a je vidět text?')
 		if not result:
 			self.log_signal.emit('Během nahrávání došlo k chybě, zkuste výrobek nahrát znovu nebo kontaktujte podporu.', 'E')
 			self.final_result.setText('CHYBA')
@@ -570,6 +755,7 @@ class ServiceWidget(QWidget):
 			return
 
 		self.data_saved_check.setChecked(True)
+		self.cycle_running = False
 
 		self.final_result.setText('OK')
 		self.final_result.setStyleSheet('color: green; font-weight: bold')
@@ -648,11 +834,11 @@ class ServiceWidget(QWidget):
 		try:
 			# If true, green will be on, else red
 			if result is True:
-				self.rf_control.set_aux_pin(1, 0)
-				self.rf_control.set_aux_pin(2, 1)
+				self.rf_control.set_aux_pins([(1, 0), (2, 1)])
 			else:
-				self.rf_control.set_aux_pin(2, 0)
-				self.rf_control.set_aux_pin(1, 1)
+				# a failed cycle ends here, the tester may start the next one
+				self.cycle_running = False
+				self.rf_control.set_aux_pins([(2, 0), (1, 1)])
 		except Exception as e:
 			print('Error while switching leds: ', e)
 
@@ -693,6 +879,10 @@ class ServiceWidget(QWidget):
 		print('Cloning repo')
 		self.log_signal.emit('Stahuji data.', 'I')
 		self.disable_gui(True)
+		if self.loop:
+			# git is killed when the stage times out or the app closes
+			self.run_stage(GitClone(REPO_URL, CLONING_PATH, WORKING_PATH).clone_async(), self.repository_cloned)
+			return
 		worker = Worker(self.clone_repo_worker)
 		worker.signals.result.connect(self.repository_cloned)
 		QThreadPool.globalInstance().start(worker)
@@ -713,6 +903,51 @@ class ServiceWidget(QWidget):
 			self.git_cloned_check.setChecked(False)
 			self.log_signal.emit('Chyba při klonování repozitáře!', 'E')
 		self.disable_gui(False)
+		if self.auto_start and not self.rf_control.start_listening():
+			# START connects again, the tester may not be plugged in yet
+			print('[WARNING] Tester not connected, waiting for START')
+
+# - - - - - - - - - ASYNC STAGES - - - - - - - - -
+	def run_stage(self, coroutine, done):
+		# the asyncio counterpart of Worker, done(result) is called in the GUI thread
+		task = self.loop.create_task(asyncio.wait_for(coroutine, self.stage_timeout))
+		self.stage_tasks.add(task)
+		task.add_done_callback(lambda task: self.stage_finished(task, done))
+		return task
+
+	def stage_finished(self, task, done):
+		self.stage_tasks.discard(task)
+		if task.cancelled():
+			print('[INFO] Stage cancelled')
+			return
+		try:
+			result = task.result()
+		except asyncio.TimeoutError:
+			self.log_signal.emit(f'Krok nebyl dokončen do {self.stage_timeout:.0f} s!', 'E')
+			result = False
+		except Exception as e:
+			print('Error in async stage: ', e)
+			result = False
+		done(result)
+
+# - - - - - - - - - TESTER EVENTS - - - - - - - - -
+	def tester_config(self):
+		config = configparser.ConfigParser()
+		config.read('config.ini')
+		if not config.has_section('TESTER'):
+			config.add_section('TESTER')
+		return config['TESTER']
+
+	def tester_event(self, event):
+		# runs in the GUI thread, the listener only emitted tester_signal
+		print('[INFO] Tester event: ', event)
+		if self.cycle_running or not self.start_continue_btn.isEnabled():
+			print('[INFO] Cycle already running, tester event ignored')
+			return
+		# the fixture button is only reachable with a board clamped in the tester
+		self.board_inserted = True
+		self.log_signal.emit('Spuštěno testerem', 'I')
+		self.start_work()
 
 # - - - - - - - - - - - - - - - - - - - - - - -
 	# get avaliable ports to connect to STM and ESP processors
@@ -858,6 +1093,10 @@ class ServiceWidget(QWidget):
 		self.data_saved_check.setChecked(False)
 		self.final_check.setChecked(False)
 
+	def progress_bar_value(self, value):
+		# progress of a running flash, already throttled by the uploader
+		self.progress_bar.setValue(value)
+
 	def update_progress(self, value):
 		# slowly update the progress bar based on the value, don't just set it
 		if value > self.progress_bar.value():
@@ -904,8 +1143,12 @@ class ServiceWidget(QWidget):
 		#	self.close()
 		if self.confirmation_msg('Ukončit', 'Opravdu chcete aplikaci ukončit?'):
 			print('The app will be closed shortly')
+			for task in list(self.stage_tasks):
+				task.cancel()
 			self.rf_control.closing_app()
 			self.psu.disconnect_psu()
+			if self.flash_pool:
+				self.flash_pool.stop()
 			self.close()
 		else:
 			print('User does not want to close the app')
@@ -1003,6 +1246,12 @@ if __name__ == '__main__':
 	sys.argv += ['-platform', 'windows:darkmode=1'] #darkmode=1 == light theme, darkmode=2  == dark theme
 	app = QApplication(sys.argv)
 	app.setStyle('windowsvista')
+	loop = None
+	if async_enabled():
+		# optional dependency, only needed with [ASYNC] Enabled, set before the widgets look the loop up
+		import qasync
+		loop = qasync.QEventLoop(app)
+		asyncio.set_event_loop(loop)
 	window = MainWindow()
 	window.setStyleSheet(
 	"""
@@ -1012,4 +1261,10 @@ if __name__ == '__main__':
 	window.show()
 	window.showMaximized()
 	
+	if loop:
+		app_closed = asyncio.Event()
+		app.aboutToQuit.connect(app_closed.set)
+		with loop:
+			loop.run_until_complete(app_closed.wait())
+		sys.exit(0)
 	sys.exit(app.exec())
\ No newline at end of file
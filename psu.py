@@ -1,6 +1,10 @@
 import time
+import asyncio
+import contextlib
 import pyvisa as visa
 
+from async_io import AsyncScpi, run_sync, SCPI_TIMEOUT
+
 class PSUControll:
 	def __init__(self):
 		self.rm = visa.ResourceManager()
@@ -399,6 +403,153 @@ class PSUControll:
 			return False
 
 
+class AsyncPSUControll(PSUControll):
+	"""PSU on an asyncio SCPI socket instead of VISA.
+
+	The *_async methods run on the event loop. The inherited measurement
+	code keeps working from worker threads, its commands are handed to the
+	loop with run_sync.
+	"""
+	def __init__(self, loop):
+		super().__init__()
+		self.loop = loop
+		self.scpi = None
+
+	async def connect_async(self, ip_address='192.168.20.126'):
+		try:
+			self.scpi = AsyncScpi(ip_address)
+			response = await self.scpi.connect()
+			print(f'[INFO] Connected to PSU: {response}')
+			self.connected = True
+			return True
+		except (OSError, asyncio.TimeoutError) as e:
+			print(f'[ERROR] while connecting to PSU: {e}')
+			self.connected = False
+			return False
+
+	async def send_command_async(self, command):
+		if not self.connected:
+			print(f'[ERROR] PSU not connected')
+			return False
+		await self.scpi.write(command)
+		print(f'[INFO] Sent command: {command}')
+		# VISA write returns the number of bytes written, callers only test it for truth
+		return len(command) + 1
+
+	async def read_response_async(self, command):
+		try:
+			response = float(await self.scpi.query(command))
+			print(f'[DEBUG] Float Response: {response}')
+			return response
+		except (OSError, ValueError, asyncio.TimeoutError) as e:
+			print('Error while reading cmd: ', e)
+			return False
+
+	@contextlib.asynccontextmanager
+	async def channel(self, channel):
+		"""Selects the output and keeps the socket until the block ends.
+
+		INST:SEL is state on the instrument, a command of another coroutine
+		between the selection and its commands would go to the wrong output.
+		"""
+		if not self.connected:
+			raise ConnectionError('PSU not connected')
+		async with self.scpi.lock:
+			await self.scpi.send('INST:SEL OUT{}'.format(channel))
+			yield
+
+	async def channel_command_async(self, channel, command):
+		try:
+			async with self.channel(channel):
+				await self.scpi.send(command)
+			print(f'[INFO] Sent command: OUT{channel} {command}')
+			return True
+		except (OSError, asyncio.TimeoutError) as e:
+			print(f'[ERROR] Error while sending OUT{channel} {command}: {e}')
+			return False
+
+	async def measure_async(self, channel, command):
+		try:
+			async with self.channel(channel):
+				response = float(await self.scpi.ask(command))
+			print(f'[DEBUG] Float Response: {response}')
+			return response
+		except (OSError, ValueError, asyncio.TimeoutError) as e:
+			print('Error while reading cmd: ', e)
+			return False
+
+	async def turn_channel_async(self, channel, status):
+		return await self.channel_command_async(channel, 'OUTP {}'.format('1' if status else '0'))
+
+	async def set_volt_curr_async(self, channel, voltage, current):
+		if voltage == 0 and current == 0:
+			return await self.turn_channel_async(channel, False)
+		if current == 0 and voltage > 0:
+			current = 0.5
 
+		if not await self.channel_command_async(channel, 'APPLY {:.2f},{:.2f}'.format(voltage, current)):
+			return False
+		# the output settles before it is switched on and measured, the socket is free meanwhile
+		await asyncio.sleep(1)
+		await self.turn_channel_async(channel, True)
+		await asyncio.sleep(1)
+
+		voltage = await self.measure_async(channel, 'MEAS:VOLT?')
+		current = await self.measure_async(channel, 'MEAS:CURR?')
+		print(f'[INFO] Channel {channel} measured {voltage}V and {current}A')
+		return True
+
+	async def start_psu_async(self, ip_address):
+		if not self.connected and not await self.connect_async(ip_address):
+			print('[ERROR] Could not connect to PSU')
+			return False
+		if not await self.set_volt_curr_async(1, 14, 0.5):
+			print('[ERROR] Could not set voltage and current')
+			return False
+		# turn off the battery
+		await self.turn_channel_async(2, False)
+		return True
+
+	# - - - blocking interface of PSUControll, for worker threads only - - -
+
+	def connect_to_psu(self, ip_address='192.168.20.126'):
+		return run_sync(self.loop, self.connect_async(ip_address))
+
+	def send_command(self, command):
+		try:
+			return run_sync(self.loop, self.send_command_async(command), SCPI_TIMEOUT)
+		except (OSError, TimeoutError) as e:
+			print(f'[ERROR] Error while sending {command}: {e}')
+			return False
+
+	def read_response(self, command):
+		return run_sync(self.loop, self.read_response_async(command), SCPI_TIMEOUT * 2)
 
+	# the channel commands of PSUControll select and act under one lock
 
+	def set_volt_curr(self, channel, voltage, current):
+		return run_sync(self.loop, self.set_volt_curr_async(channel, voltage, current), SCPI_TIMEOUT * 4 + 2)
+
+	def turn_channel(self, channel, status):
+		return run_sync(self.loop, self.turn_channel_async(channel, status), SCPI_TIMEOUT * 2)
+
+	def set_voltage(self, channel, voltage):
+		return run_sync(self.loop, self.channel_command_async(channel, 'SOUR:VOLT {:.2f}'.format(voltage)), SCPI_TIMEOUT * 2)
+
+	def set_current(self, channel, current):
+		return run_sync(self.loop, self.channel_command_async(channel, 'SOUR:CURR {:.2f}'.format(current)), SCPI_TIMEOUT * 2)
+
+	def get_voltage(self, channel):
+		return run_sync(self.loop, self.measure_async(channel, 'MEAS:VOLT?'), SCPI_TIMEOUT * 2)
+
+	def get_current(self, channel):
+		return run_sync(self.loop, self.measure_async(channel, 'MEAS:CURR?'), SCPI_TIMEOUT * 2)
+
+	def disconnect_psu(self):
+		# called from the GUI thread, closing the socket needs no waiting
+		if self.scpi:
+			self.scpi.close()
+			self.scpi = None
+			print('[INFO] Disconnected from PSU')
+		self.connected = False
+		return True
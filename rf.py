@@ -1,8 +1,13 @@
 import time
+import queue
+import asyncio
 import serial
 import serial.tools.list_ports
 import binascii
 import threading
+import itertools
+import collections
+import concurrent.futures
 
 
 # RF USB CONTROL SETTINGS
@@ -14,6 +19,11 @@ BAUD_RATE = 9600
 PARITY = serial.PARITY_NONE
 STOP_BITS = serial.STOPBITS_ONE
 BYTE_SIZE = serial.EIGHTBITS
+# seconds the reader blocks in one read, bounds how long stopping it takes
+READ_TIMEOUT = 0.1
+# frames waiting for the writer, send_data gives up after WRITE_TIMEOUT when it stays full
+OUTBOUND_QUEUE_SIZE = 64
+WRITE_TIMEOUT = 1
 
 #PINS 
 RED_LED = 1
@@ -22,7 +32,24 @@ PROGRAMMING_MODE = 3
 ESP_ON_OFF = 4
 
 SYNC_HEADER = b'\x2D\xD4'
-PACKET_LENGTH = 9
+# events of the tester, published for the packets in PACKET_EVENTS
+START_BUTTON = 'start_button'
+BOARD_INSERTED = 'board_inserted'
+# matched on the header CRC and the payload, packet[5:-1]
+PACKET_EVENTS = {
+	b'\x06\xD3': START_BUTTON,
+	b'\x07\x05y': BOARD_INSERTED,
+}
+
+# seconds to wait for the tester to acknowledge a command
+ACK_TIMEOUT = 0.5
+# round trip times kept for latency_stats()
+LATENCY_HISTORY = 100
+
+# sync, length, 2 reserved bytes and the header CRC
+HEADER_LENGTH = 6
+# packet CRC after the payload
+MIN_PACKET_LENGTH = HEADER_LENGTH + 1
 
 
 class Crc8:
@@ -42,19 +69,176 @@ class Crc8:
 			table[i] = crc & 0xFF
 		return table
 		
-	def calculate_crc(self, data):
-		crc = 0
+	def calculate_crc(self, data, crc=0):
+		"""crc continues a previous calculation, data can be a memoryview"""
+		table = self.table
 		for byte in data:
-			crc = self.table[crc ^ byte]
+			crc = table[crc ^ byte]
 		return crc
+
+
+class PacketDecoder:
+	"""Splits the tester byte stream into packets.
+
+	feed() appends the received bytes and returns the complete packets with
+	valid header and packet CRCs. The sync word is searched with find() and
+	the CRCs run over memoryview slices, nothing is copied per byte and every
+	returned packet is copied once. Noise and corrupted packets are skipped
+	up to the next sync word and reported as one warning per burst.
+	"""
+	def __init__(self, crc8=None):
+		self.crc8 = crc8 or Crc8()
+		self.buffer = bytearray()
+		self.packets = 0
+		self.crc_errors = 0
+		self.dropped = 0 # noise bytes in the current burst
+
+	def feed(self, data):
+		buffer = self.buffer
+		buffer.extend(data)
+		packets = []
+		position = 0
+		with memoryview(buffer) as view:
+			while True:
+				start = buffer.find(SYNC_HEADER, position)
+				if start < 0:
+					# the last unconsumed byte may be the first half of the sync word
+					keep = 1 if position < len(buffer) and buffer[-1] == SYNC_HEADER[0] else 0
+					self.drop(len(buffer) - keep - position)
+					position = len(buffer) - keep
+					break
+				self.drop(start - position)
+				position = start
+
+				if len(buffer) - start < HEADER_LENGTH:
+					break
+				# no slice kept alive, the buffer can only be resized once all views are gone
+				if self.crc8.calculate_crc(view[start + 2:start + HEADER_LENGTH - 1]) != buffer[start + HEADER_LENGTH - 1]:
+					self.corrupted('header')
+					position = start + 1
+					continue
+
+				end = start + MIN_PACKET_LENGTH + buffer[start + 2]
+				if len(buffer) < end:
+					break
+				crc = self.crc8.calculate_crc(view[start:end - 1])
+				if crc != buffer[end - 1]:
+					self.corrupted('packet')
+					position = start + 1
+					continue
+
+				self.report_noise()
+				packets.append(bytes(view[start:end]))
+				self.packets += 1
+				position = end
+		# bytearray drops a prefix without moving the rest
+		del buffer[:position]
+		return packets
+
+	def drop(self, count):
+		self.dropped += count
+
+	def corrupted(self, part):
+		self.crc_errors += 1
+		# the false sync byte is noise as well
+		self.dropped += 1
+		print(f'[ERROR] Invalid {part} CRC, resynchronizing')
+
+	def report_noise(self):
+		if self.dropped:
+			print(f'[WARNING] Skipped {self.dropped} bytes without a valid packet')
+			self.dropped = 0
+
 	
+class TesterEvent:
+	"""Typed event published for a received tester packet"""
+	def __init__(self, kind, packet):
+		self.kind = kind
+		self.packet = packet
+		self.received = time.monotonic()
+
+	def __repr__(self):
+		return f'TesterEvent({self.kind}, {self.packet})'
+
+
+class TesterEventBus:
+	"""Handlers registered per event kind, called from the listener thread.
+
+	Handlers must not block the listener, the GUI hands the events over to
+	its own thread with a queued Qt signal.
+	"""
+	def __init__(self):
+		self.handlers = {}
+		self.lock = threading.Lock()
+
+	def subscribe(self, kind, handler):
+		with self.lock:
+			self.handlers.setdefault(kind, []).append(handler)
+
+	def unsubscribe(self, kind, handler):
+		with self.lock:
+			if handler in self.handlers.get(kind, []):
+				self.handlers[kind].remove(handler)
+
+	def publish(self, event):
+		with self.lock:
+			handlers = list(self.handlers.get(event.kind, []))
+		for handler in handlers:
+			try:
+				handler(event)
+			except Exception as e:
+				print(f'[ERROR] Handler of {event.kind} failed: {e}')
+
+
+class AuxCommand:
+	"""Pin operations sent in one frame, future resolves with the round trip time in seconds.
+
+	Without acknowledgements the command is complete once it is written.
+	"""
+	def __init__(self, seq, payload):
+		self.seq = seq
+		self.payload = payload
+		self.future = concurrent.futures.Future()
+		self.sent = None
+		self.latency = None
+
+	def complete(self):
+		if self.future.done():
+			return
+		self.latency = time.monotonic() - self.sent
+		self.future.set_result(self.latency)
+
+	def wait(self, timeout=ACK_TIMEOUT):
+		try:
+			self.future.result(timeout)
+			return True
+		except (concurrent.futures.TimeoutError, OSError) as e:
+			print(f'[ERROR] Command {self.seq} {bytes(self.payload)} not completed: {str(e) or "timeout"}')
+			return False
+
+	def __repr__(self):
+		return f'AuxCommand({self.seq}, {bytes(self.payload)})'
+
+
 class SerialConnection:
-	"""Serial connection utility class"""
+	"""Full-duplex serial connection to the tester.
+
+	A reader thread collects incoming bytes into the received queue and a
+	writer thread writes the frames from a bounded outbound queue, one frame
+	per write. A command never waits behind a blocking read and frames sent
+	from several threads cannot interleave.
+	"""
 	def __init__(self, device_name='Silicon Labs'):
 		self.device_name = device_name
 		self.serial_connection = None
 		self.port_open = False
-		self.lock = threading.Lock()
+		self.lock = threading.Lock() # open and close
+		self.close_lock = threading.Lock() # the handle itself, also closed by the reader or writer
+		self.stop = threading.Event()
+		self.outbound = queue.Queue(maxsize=OUTBOUND_QUEUE_SIZE)
+		self.received = queue.Queue()
+		self.reader = None
+		self.writer = None
 	
 	def find_port(self):
 		"""Find the port for the device"""
@@ -66,56 +250,139 @@ class SerialConnection:
 	def open_port(self):
 		"""Open the serial port"""
 		try:
-			port = self.find_port()
-			if port:
-				if self.port_open == True:
-					print('[DEBUG] Tester already connected')
+			with self.lock:
+				port = self.find_port()
+				if port:
+					if self.port_open == True:
+						print('[DEBUG] Tester already connected')
+						return True
+					# short read timeout, it only bounds how long the reader takes to notice stop
+					self.serial_connection = serial.Serial(port, baudrate=BAUD_RATE, timeout=READ_TIMEOUT, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, bytesize=serial.EIGHTBITS)
+					self.stop.clear()
+					self.outbound = queue.Queue(maxsize=OUTBOUND_QUEUE_SIZE)
+					self.received = queue.Queue()
+					self.reader = threading.Thread(target=self.read_loop, daemon=True)
+					self.writer = threading.Thread(target=self.write_loop, daemon=True)
+					self.port_open = True
+					self.reader.start()
+					self.writer.start()
+					print(f'[INFO] Opened port: {port}')
 					return True
-				self.serial_connection = serial.Serial(port, baudrate=BAUD_RATE, timeout=1, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, bytesize=serial.EIGHTBITS)
-				self.port_open = True
-				print(f'[INFO] Opened port: {port}')
-				return True
-			else:
-				print(f'[ERROR] Device {self.device_name} not found')
-				return False
+				else:
+					print(f'[ERROR] Device {self.device_name} not found')
+					return False
 		except Exception as e:
 			print(f'[ERROR] Error while opening port: {e}')
 			return False
 		
 	def close_port(self):
-		"""Close the serial port"""
-		while self.lock:
-			if self.serial_connection and self.serial_connection.is_open:
-				# Reset buffers and close the port
-				self.serial_connection.reset_input_buffer()
-				self.serial_connection.reset_output_buffer()
-				self.serial_connection.flush()
-
-				self.serial_connection.close()
-				self.port_open = False
-				print(f'[INFO] Port has been closed')
-				return True
-			else:
+		"""Close the serial port, frames already queued are written first"""
+		with self.lock:
+			if not (self.serial_connection and self.serial_connection.is_open):
 				print(f'[ERROR] Port is not open')
 				return False
 
+			self.port_open = False
+			self.stop.set()
+			try:
+				# wakes the writer once the queued frames are written
+				self.outbound.put(None, timeout=WRITE_TIMEOUT)
+			except queue.Full:
+				pass
+			for thread in (self.writer, self.reader):
+				if thread and thread is not threading.current_thread():
+					thread.join(timeout=WRITE_TIMEOUT + READ_TIMEOUT)
+
+			self.close_connection(flush=True)
+			print(f'[INFO] Port has been closed')
+			return True
+
+	def close_connection(self, flush=False):
+		"""Closes the serial handle once, whichever of close_port and connection_lost comes first"""
+		with self.close_lock:
+			if not (self.serial_connection and self.serial_connection.is_open):
+				return
+			if flush:
+				# only on a working port, a lost one fails here
+				self.serial_connection.reset_input_buffer()
+			self.serial_connection.close()
+
 	def send_data(self, data):
-		"""Send data over the serial port"""
-		if self.port_open and self.serial_connection:
-			self.serial_connection.write(data)
-			print(f'[INFO] Sent data: {data}')
-				
-		else:
-			print(f'[ERROR] Port is not open')
-	
-	def read_data(self, size):
-		"""Read data from the serial port"""
-		if self.port_open and self.serial_connection:
-			with self.lock:
-				return self.serial_connection.read(size)
-		else:
+		"""Queues data for the writer thread.
+
+		Returns a concurrent.futures.Future completed once the data is written,
+		None when the port is not open or the queue stays full.
+		"""
+		if not self.port_open or self.stop.is_set():
 			print(f'[ERROR] Port is not open')
 			return None
+		written = concurrent.futures.Future()
+		try:
+			self.outbound.put((bytes(data), written), timeout=WRITE_TIMEOUT)
+		except queue.Full:
+			print(f'[ERROR] Outbound queue full, tester not responding')
+			return None
+		return written
+
+	def write_loop(self):
+		while True:
+			item = self.outbound.get()
+			if item is None:
+				break
+			data, written = item
+			try:
+				self.serial_connection.write(data)
+				print(f'[INFO] Sent data: {data}')
+				written.set_result(len(data))
+			except (serial.SerialException, OSError) as e:
+				written.set_exception(e)
+				self.connection_lost(e)
+		# frames queued after close are not written
+		while True:
+			try:
+				item = self.outbound.get_nowait()
+			except queue.Empty:
+				break
+			if item:
+				item[1].set_exception(OSError('port closed'))
+
+	def read_loop(self):
+		while not self.stop.is_set():
+			try:
+				data = self.serial_connection.read(self.serial_connection.in_waiting or 1)
+			except (serial.SerialException, OSError, TypeError) as e:
+				# TypeError: pyserial on a port closed under the read
+				self.connection_lost(e)
+				break
+			if data:
+				self.received.put(data)
+
+	def connection_lost(self, error):
+		if self.stop.is_set():
+			return
+		print(f'[ERROR] Tester connection lost: {error}')
+		self.port_open = False
+		self.stop.set()
+		# the writer fails the remaining frames
+		try:
+			self.outbound.put_nowait(None)
+		except queue.Full:
+			pass
+		# the other thread notices the closed handle and stops as well
+		self.close_connection()
+
+	def read_available(self, timeout=READ_TIMEOUT):
+		"""Everything received so far, waits up to timeout for data. None once the port is closed"""
+		chunks = []
+		try:
+			chunks.append(self.received.get(timeout=timeout))
+			while True:
+				chunks.append(self.received.get_nowait())
+		except queue.Empty:
+			pass
+		if not chunks and not self.port_open:
+			return None
+		return b''.join(chunks)
 		
 	def check_port(self):
 		if not self.port_open:
@@ -124,95 +391,228 @@ class SerialConnection:
 	
 class RfUSBControl:
 	"""RF USB Control for handling packets and auxiliary pins."""
-	def __init__(self):
+	def __init__(self, ack_commands=False, packed_commands=False):
 		self.serial_connection_class = SerialConnection(device_name="Silicon Labs")
 		self.crc8 = Crc8()
+		self.events = TesterEventBus()
 		self.stop_listening = False
+		self.listen_thread = None
+		# both need tester firmware support: ACK packets echoing the sequence number
+		# in header byte 1, and several pin operations in one payload
+		self.ack_commands = ack_commands
+		self.packed_commands = packed_commands
+		self.sequence = itertools.cycle(range(1, 256)) # 0 = no acknowledgement expected
+		self.pending = {} # seq: AuxCommand waiting for its ACK
+		self.pending_lock = threading.Lock()
+		self.latencies = collections.deque(maxlen=LATENCY_HISTORY)
 
 	def start_listening(self):
 		if not self.serial_connection_class.open_port():
 			print('[ERROR] Connection to testing device failed!')
 			return False
+		elif self.listen_thread and self.listen_thread.is_alive():
+			# already listening, a second reader would split the packets between two decoders
+			return True
 		else:
-			self.listen_thread = threading.Thread(target=self.listen)
+			self.stop_listening = False
+			self.listen_thread = threading.Thread(target=self.listen, daemon=True)
 			self.listen_thread.start()
 			return True
 
-	def send_packet(self, payload):
-		"""Constructs and sends a packet with the given payload."""
-		header = bytearray([len(payload), 0, 0])
+	def build_packet(self, payload, seq=0):
+		"""Constructs a packet with the given payload."""
+		header = bytearray([len(payload), seq, 0])
 		crc_header = self.crc8.calculate_crc(header)
 		header.append(crc_header)
 
 		packet = bytearray(SYNC_HEADER + header + payload)
 		crc_packet = self.crc8.calculate_crc(packet)
 		packet.append(crc_packet)
+		return packet
 
-		self.serial_connection_class.send_data(packet)
+	def send_packet(self, payload):
+		"""Constructs and sends a packet with the given payload."""
+		return self.serial_connection_class.send_data(self.build_packet(payload)) is not None
 
-	def set_aux_pin(self, pin, state):
-		"""Sets the state of the given auxiliary pin."""
-		payload = bytearray([pin, state])
-		self.send_packet(payload)
-		return True
-	
-	def set_aux_blinking(self, pin, blink_time):
+	def pin_payload(self, pin, state):
+		return bytearray([pin, state])
+
+	def blink_payload(self, pin, blink_time):
 		payload = bytearray(5)
 		payload[0] = (pin + 0x07)
 		payload[1:5] = blink_time.to_bytes(4, byteorder = 'little')
-		self.send_packet(payload)
+		return payload
+
+	def send_commands(self, payloads):
+		"""Sends pin operations in one write and returns their AuxCommands.
+
+		With packed_commands all payloads share one frame, otherwise every
+		payload gets its own frame and the frames go out as one burst.
+		"""
+		if self.packed_commands and len(payloads) > 1:
+			payloads = [b''.join(payloads)]
+		commands = [AuxCommand(next(self.sequence) if self.ack_commands else 0, payload) for payload in payloads]
+		data = b''.join(self.build_packet(command.payload, command.seq) for command in commands)
+
+		if self.ack_commands:
+			with self.pending_lock:
+				for command in commands:
+					self.pending[command.seq] = command
+		sent = time.monotonic()
+		for command in commands:
+			command.sent = sent
+		written = self.serial_connection_class.send_data(data)
+		if written is None:
+			self.fail_commands(commands, OSError('tester port is not open'))
+		else:
+			written.add_done_callback(lambda future: self.commands_written(commands, future))
+		return commands
+
+	def commands_written(self, commands, future):
+		# called by the writer thread
+		if future.exception():
+			self.fail_commands(commands, future.exception())
+		elif not self.ack_commands:
+			for command in commands:
+				command.complete()
+
+	def fail_commands(self, commands, error):
+		for command in commands:
+			self.forget(command)
+			if not command.future.done():
+				command.future.set_exception(error)
+
+	def execute(self, payloads, timeout=ACK_TIMEOUT, spacing=0):
+		"""Sends pin operations and waits until all of them are completed.
+
+		Without ACKs nothing tells when the tester has switched a pin, the
+		frames then go out one at a time with spacing seconds after each.
+		"""
+		if self.ack_commands:
+			return self.wait_commands(self.send_commands(payloads), timeout)
+		results = []
+		for group in self.frame_groups(payloads):
+			results.append(self.wait_commands(self.send_commands(group), timeout))
+			time.sleep(spacing)
+		return all(results)
+
+	def frame_groups(self, payloads):
+		# the payloads of one frame each, all of them in one frame with packed_commands
+		if self.packed_commands:
+			return [payloads]
+		return [[payload] for payload in payloads]
+
+	def wait_commands(self, commands, timeout):
+		deadline = time.monotonic() + timeout
+		results = [command.wait(max(0, deadline - time.monotonic())) for command in commands]
+		for command in commands:
+			self.forget(command)
+			if command.latency is not None:
+				self.latencies.append(command.latency)
+		return all(results)
+
+	async def execute_async(self, payloads, timeout=ACK_TIMEOUT, spacing=0):
+		"""execute() for the asyncio loop, awaits the commands instead of blocking the thread"""
+		if self.ack_commands:
+			return await self.wait_commands_async(self.send_commands(payloads), timeout)
+		results = []
+		for group in self.frame_groups(payloads):
+			results.append(await self.wait_commands_async(self.send_commands(group), timeout))
+			await asyncio.sleep(spacing)
+		return all(results)
+
+	async def wait_commands_async(self, commands, timeout):
+		try:
+			await asyncio.wait_for(asyncio.gather(*(asyncio.wrap_future(command.future) for command in commands)), timeout)
+			return True
+		except (asyncio.TimeoutError, OSError) as e:
+			print(f'[ERROR] Commands {commands} not completed: {str(e) or "timeout"}')
+			return False
+		finally:
+			for command in commands:
+				self.forget(command)
+				if command.latency is not None:
+					self.latencies.append(command.latency)
+
+	def set_aux_pins_async(self, states, spacing=0):
+		return self.execute_async([self.pin_payload(pin, state) for pin, state in states], spacing=spacing)
+
+	def forget(self, command):
+		with self.pending_lock:
+			if self.pending.get(command.seq) is command:
+				del self.pending[command.seq]
+
+	def acknowledge(self, seq):
+		"""Completes the command with the sequence number, False for packets that are no ACK"""
+		with self.pending_lock:
+			command = self.pending.pop(seq, None)
+		if not command:
+			return False
+		command.complete()
 		return True
 
+	def latency_stats(self):
+		"""(count, average, maximum) of the recent command round trips in seconds"""
+		latencies = list(self.latencies)
+		if not latencies:
+			return 0, 0, 0
+		return len(latencies), sum(latencies) / len(latencies), max(latencies)
+
+	def set_aux_pin(self, pin, state):
+		"""Sets the state of the given auxiliary pin."""
+		return self.execute([self.pin_payload(pin, state)])
+
+	def set_aux_pins(self, states, spacing=0):
+		"""Sets [(pin, state)] in one burst or frame, returns once all are completed.
+
+		spacing is the settling time after every frame when the tester sends no ACKs.
+		"""
+		return self.execute([self.pin_payload(pin, state) for pin, state in states], spacing=spacing)
+	
+	def set_aux_blinking(self, pin, blink_time):
+		return self.execute([self.blink_payload(pin, blink_time)])
+
 	def reset_pin(self, pin, state, delay):
 		"""Sets the state of the given auxiliary pin for a specified duration."""
+		# the pulse is timed from the completed command, not from the write
 		self.set_aux_pin(pin, not state)
 		time.sleep(delay)
 		self.set_aux_pin(pin, state)
 
 	def listen(self):
 		"""Listens for incoming data on the serial port."""
-		buffer = bytearray()
+		decoder = PacketDecoder(self.crc8)
 		print("[INFO] Starting listener")
 
 		while not self.stop_listening:
-			data = self.serial_connection_class.read_data(PACKET_LENGTH)
+			data = self.serial_connection_class.read_available()
+			if data is None:
+				break
 			if data:
-				buffer.extend(data)
-
-				while len(buffer) >= PACKET_LENGTH:
-					packet = buffer[:PACKET_LENGTH]
-					sync_header = packet[:2]
-
-					if sync_header == SYNC_HEADER:
-						crc_calculated = self.crc8.calculate_crc(packet[:-1])
-						if crc_calculated == packet[-1]:
-							print(f"[INFO] Valid packet received: {packet}")
-							self._process_packet(packet)
-						else:
-							print("[ERROR] Invalid CRC, discarding packet")
-						buffer = buffer[PACKET_LENGTH:]
-					else:
-						print("[WARNING] Sync header not found, shifting buffer")
-						buffer.pop(0)
+				for packet in decoder.feed(data):
+					print(f"[INFO] Valid packet received: {packet}")
+					self._process_packet(packet)
 
 		print("[INFO] Listener stopped")
 
 	def _process_packet(self, packet):
 		"""Processes a received packet."""
-		payload = packet[5:-1]
-		if payload == b'\x06\xD3':
-			print("[INFO] Start work signal detected")
-		elif payload == b'\x07\x05y':
-			print("[INFO] New device signal detected")
+		if self.ack_commands and packet[3] and self.acknowledge(packet[3]):
+			return
+		kind = PACKET_EVENTS.get(bytes(packet[5:-1]))
+		if kind:
+			print(f"[INFO] Tester event: {kind}")
+			self.events.publish(TesterEvent(kind, packet))
 
 	def closing_app(self):
 		try:
 			if not self.serial_connection_class.check_port():
 				return True
-			self.set_aux_pin(1,0)
-			self.set_aux_pin(2,0)
-			self.set_aux_pin(3, 0)
-			self.set_aux_pin(4, 0)
+			# completed before the listener stops, it receives the ACKs
+			self.set_aux_pins([(1, 0), (2, 0), (3, 0), (4, 0)])
+			count, average, maximum = self.latency_stats()
+			if count:
+				print(f'[INFO] Tester commands: {count}, round trip {average * 1000:.1f} ms average, {maximum * 1000:.1f} ms max')
 			self.stop_listening = True
 
 			# stop listening thread:
@@ -0,0 +1,68 @@
+"""Throughput of the tester packet decoder.
+
+Builds a stream of packets with random payload lengths, optionally with
+noise bursts and corrupted packets between them, and feeds it to
+PacketDecoder in chunks of the given size:
+
+	python rf_benchmark.py --packets 100000 --chunk 64 --noise 0.1
+"""
+import os
+import time
+import random
+import argparse
+import contextlib
+
+from rf import RfUSBControl, PacketDecoder
+
+
+def build_stream(rf, packets, noise, seed=1):
+	"""Returns the stream and the packets a decoder has to find in it"""
+	rng = random.Random(seed)
+	stream = bytearray()
+	expected = []
+	for _ in range(packets):
+		if rng.random() < noise:
+			if rng.random() < 0.5:
+				# noise burst
+				stream.extend(os.urandom(rng.randint(1, 64)))
+			else:
+				# packet with a flipped payload byte, has to fail the packet CRC
+				packet = rf.build_packet(os.urandom(rng.randint(1, 32)))
+				packet[-2] ^= 0xFF
+				stream.extend(packet)
+		packet = bytes(rf.build_packet(os.urandom(rng.randint(1, 32))))
+		stream.extend(packet)
+		expected.append(packet)
+	return bytes(stream), expected
+
+
+def run(stream, chunk):
+	decoder = PacketDecoder()
+	received = []
+	# the decoder warnings are not part of the measurement
+	with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+		started = time.perf_counter()
+		for offset in range(0, len(stream), chunk):
+			received.extend(decoder.feed(stream[offset:offset + chunk]))
+		elapsed = time.perf_counter() - started
+	return received, elapsed
+
+
+def main():
+	parser = argparse.ArgumentParser(description='RF tester packet decoder benchmark')
+	parser.add_argument('--packets', type=int, default=50000)
+	parser.add_argument('--chunk', type=int, nargs='+', default=[1, 9, 64, 4096], help='bytes per feed() call')
+	parser.add_argument('--noise', type=float, default=0.1, help='share of packets preceded by noise or a corrupted packet')
+	args = parser.parse_args()
+
+	stream, expected = build_stream(RfUSBControl(), args.packets, args.noise)
+	print(f'{len(stream)} bytes, {len(expected)} packets, noise {args.noise}')
+	for chunk in args.chunk:
+		received, elapsed = run(stream, chunk)
+		# random noise can hold a valid looking packet, every real one has to be found
+		missing = len(set(expected) - set(received))
+		print(f'chunk {chunk:5}: {len(stream) / elapsed / 1e6:6.2f} MB/s, {len(received) / elapsed:9.0f} packets/s, {missing} missing')
+
+
+if __name__ == '__main__':
+	main()
@@ -1,14 +1,29 @@
 import os
-import json
 import serial
-import subprocess
 import configparser
 import serial.tools.list_ports
 
+from eeprom import EepromImage
+from image_cache import ImageCache
+from swd_clock import SwdClockTuner
+from cli_runner import StreamingCommand, STLINK_PATTERNS
+from stm_job import StmJobRunner
+from erase_plan import ErasePlanner
+from stm_backend import STLinkCLIBackend, OpenOCDBackend, openocd_command, FLASH_BASE
+
 class UploadSTM:
 
-	def __init__(self, device):
+	def __init__(self, device, backend=None, rework=None, probe_id=0, probe_serial=None, eeprom_file=None, progress=None):
 		self.device = device
+		self.backend = backend
+		self.rework = rework # None = take Rework_Mode from config.ini
+		self.probe_id = probe_id # index in the -List output
+		self.eeprom_override = eeprom_file # per board profile (gang programming)
+		self.progress = progress # called with the name of every step
+		self.image_cache = ImageCache()
+		self.eeprom_mismatch = []
+		self.swd_tuner = SwdClockTuner()
+		self.probe_serial = probe_serial
 
 	def upload_stm(self):
 		# 1. load config
@@ -20,70 +35,180 @@ class UploadSTM:
 		# 7. write EEPROM (in data/)
 		
 		self.load_config()
+		if self.mode == 'script':
+			# the whole sequence as one scripted OpenOCD run
+			return StmJobRunner(self).run()
+
+		if self.backend is None:
+			self.backend = self.create_backend()
+		if self.verify_mode == 'checksum' and not self.backend.checksum_verify:
+			print('[WARNING] Verify_Mode = checksum needs Backend = openocd, verifying with -V')
+
+		try:
+			result = self.run_steps()
+			if not result[0] and self.backend.probe_error and self.swd_autotune and self.probe_serial:
+				# the probe lost the target at the tuned clock, calibrate again from the configured Frequency
+				self.swd_tuner.forget(self.probe_serial)
+			return result
+		finally:
+			self.backend.close()
+
+	def report(self, step):
+		if self.progress:
+			self.progress(step)
+
+	def run_steps(self):
+		self.report('connect')
 		if not self.find_and_connect_st():
 			print('No STM found')
 			return False, 'Error while searching for STM'
-		
+
+		if self.rework:
+			self.report('rework')
+			result = self.upload_changed_regions()
+			if result is not None:
+				return result
+			print('Flash contents could not be checked, running the full sequence')
+	
+		self.report('erase')
 		if not self.erase_st():
 			print('Error erasing STM')
 			return False, 'Error while erasing STM'
-		
+	
+		self.report('startloader')
 		if not self.upload_startloader():
 			print('Error uploading startloader')
 			return False, 'Error while uploading startloader'
-		
+	
+		self.report('bootloader')
 		if not self.upload_bootloader():
 			print('Error uploading bootloader')
 			return False, 'Error while uploading bootloader'
-		
+	
+		self.report('application')
 		if not self.upload_application():
 			print('Error uploading application')
-			return False
-		
+			return False, 'Error while uploading application'
+	
+		self.report('eeprom')
 		if not self.write_to_eeprom():
 			print('Error writing to EEPROM')
-			return False, 'Error while writing to eeprom'
-		
+			return False, self.eeprom_error()
+	
 		return True, 'Process finished successfully'
 
-	def find_and_connect_st(self):
-		found = self.run_command('-List')
-		if not found:			
+	def upload_changed_regions(self):
+		# rework mode: only regions whose on-chip contents differ are erased (by -P) and programmed
+		regions = [
+			('startloader', self.startloader, self.start_address),
+			('bootloader', self.bootloader, self.boot_address),
+			('application', self.application, self.app_address),
+		]
+		changed = []
+		for name, path, address in regions:
+			if not os.path.exists(path):
+				return False, f'Error while uploading {name}'
+			matches = self.region_matches(path, int(address, 16))
+			if matches is None:
+				return None
+			print(f'Region {name} at {address}: ' + ('unchanged' if matches else 'differs'))
+			if not matches:
+				changed.append((name, path, address))
+
+		for name, path, address in changed:
+			if not self.program_image(path, int(address, 16)):
+				print(f'Error uploading {name}')
+				return False, f'Error while uploading {name}'
+
+		if not self.write_to_eeprom():
+			print('Error writing to EEPROM')
+			return False, self.eeprom_error()
+
+		return True, f'Process finished successfully, reprogrammed {len(changed)} of {len(regions)} regions'
+
+	def program_image(self, path, address):
+		# checksum mode verifies against the cached CRC of the .BIN instead of reading the image back,
+		# only where the backend computes a real CRC on the target (OpenOCD), ST-LINK_CLI keeps -V
+		checksum = self.verify_mode == 'checksum' and self.backend.checksum_verify
+		if not self.backend.program(path, address, verify=not checksum):
 			return False
-		
+		if not checksum:
+			return True
 
-		connected = self.run_command('-c', 'ID=0', 'SWD', 'UR', f'freq={self.frequency}', 'V', '-NoPrompt')
+		matches = self.region_matches(path, address)
+		if not matches:
+			print(f'Checksum of {path} at 0x{address:08X} does not match')
+			return False
+		return True
+
+	def region_matches(self, path, address):
+		digest = self.image_cache.digest(path)
+		return self.backend.region_matches(digest, address)
+
+	def find_and_connect_st(self):
+		connected = self.backend.open()
 		if not connected:
 			return False
 
 		print('Connected to STM with result: ' + str(connected))
+		self.tune_swd_clock()
 		return True
+
+	def tune_swd_clock(self):
+		# use the clock found for this probe before, calibrate it once if allowed
+		self.probe_serial = self.backend.probe_serial() or self.probe_serial
+		if not self.probe_serial:
+			return
+
+		frequency = self.swd_tuner.frequency(self.probe_serial)
+		if frequency and frequency >= int(self.frequency):
+			print(f'Using SWD clock {frequency} kHz for probe {self.probe_serial}')
+			self.backend.set_frequency(frequency)
+		elif self.swd_autotune:
+			self.swd_tuner.calibrate(self.probe_serial, self.backend, self.frequency)
+			# calibration fails on purpose above the usable clock, that is no error of the upload
+			self.backend.probe_error = False
 	
 	def erase_st(self):
-		# check if read out protection is enabled
-		read_out_protection = self.run_command('-c', 'ID=0', 'SWD', 'UR', f'freq={self.frequency}', '-OB', 'RDP=0', '-V', '-NoPrompt', '-Run')
-		if not read_out_protection:
-			return False
+		# read the option bytes once, RDP is only removed when it is set (or unknown)
+		rdp = self.backend.read_protection_level()
+		print('Read out protection level: ', rdp)
 
-		print('Erased STM with result: ' + str(read_out_protection))
+		try:
+			plan = self.erase_planner().plan(rdp, self.flash_images())
+		except OSError as e:
+			print('Error while planning erase: ', e)
+			return False
+		print('Erase plan: ', plan)
 
+		if plan.remove_protection:
+			read_out_protection = self.backend.remove_protection()
+			if not read_out_protection:
+				return False
+			print('Erased STM with result: ' + str(read_out_protection))
 
-		erased_eeprom = self.run_command('-c', 'ID=0', 'SWD', f'freq={self.frequency}', '-SE', 'ed1', '-V', '-NoPrompt', '-Run')
-		if not erased_eeprom:
-			return False
-		
-		erased_chip = self.run_command('-c', 'ID=0', 'SWD', f'freq={self.frequency}', '-ME', '-V', '-NoPrompt', '-Run')
-		if not erased_chip:
-			return False
+		for first, last in plan.sector_ranges:
+			if not self.backend.erase_sectors(first, last):
+				return False
 		
 		return True
+
+	def erase_planner(self):
+		return ErasePlanner(FLASH_BASE, self.sector_size)
+
+	def flash_images(self):
+		return [
+			(self.startloader, int(self.start_address, 16)),
+			(self.bootloader, int(self.boot_address, 16)),
+			(self.application, int(self.app_address, 16)),
+		]
 	
 	def upload_startloader(self):
 		# first check if file exists
 		if not os.path.exists(self.startloader):
 			return False
 		
-		uploaded = self.run_command('-c', 'ID=0', 'SWD', 'UR', f'freq={self.frequency}', '-P', self.startloader, f'0x{self.start_address}', '-V', '-NoPrompt', '-Run')
+		uploaded = self.program_image(self.startloader, int(self.start_address, 16))
 		if not uploaded:
 			return False
 
@@ -94,7 +219,7 @@ class UploadSTM:
 		if not os.path.exists(self.bootloader):
 			return False
 		
-		uploaded = self.run_command('-c', 'ID=0', 'SWD', 'UR', f'freq={self.frequency}', '-P', self.bootloader, f'0x{self.boot_address}', '-V', '-NoPrompt', '-Run')
+		uploaded = self.program_image(self.bootloader, int(self.boot_address, 16))
 		if not uploaded:
 			return False
 
@@ -105,7 +230,7 @@ class UploadSTM:
 		if not os.path.exists(self.application):
 			return False
 		
-		uploaded = self.run_command('-c', 'ID=0', 'SWD', 'UR', f'freq={self.frequency}', '-P', self.application, f'0x{self.app_address}', '-V', '-NoPrompt', '-Run')
+		uploaded = self.program_image(self.application, int(self.app_address, 16))
 		if not uploaded:
 			return False
 
@@ -115,95 +240,71 @@ class UploadSTM:
 		# first check if file exists
 		if not os.path.exists(self.eeprom_file):
 			return False
-		
-		# read eeprom file
-		with open(self.eeprom_file, 'r') as file:
-			eeprom_data = json.load(file)
-
-		for item in eeprom_data:
-			address = item.get('address')
-			value = item.get('value')
-			if value:
-				if value.isdigit():
-					value = int(value)
-					if value < 256:
-						value = f'0x{value:02x}'
-					else:
-						value = f'0x{value:X}'
-				else:
-					byte_value = value.encode('utf-8')
-					value = ''.join(f'{byte:02X}' for byte in byte_value)
-					value = f'0x{value}'
-				
-				result = self.write_value(address, value)
-				if not result:
-					return False
-				else:
-					print(f'Wrote value {value} at address {address}')
-					print('Result: ' + str(result))
-			else:
-				print('No value found in EEPROM file, continuing...')
-				continue
-		
+
+		# compile the whole profile into one image and program it in a single pass
+		try:
+			image = EepromImage.from_profile(self.eeprom_file)
+		except (ValueError, KeyError) as e:
+			print('Error while compiling EEPROM image: ', e)
+			return False
+
+		if not len(image):
+			print('No value found in EEPROM file, nothing to write')
+			return True
+
+		for name, address, length in image.fields:
+			print(f'EEPROM field "{name}" at 0x{address:08X} ({length} B)')
+
+		print(f'Writing {len(image)} B block at 0x{image.base:08X}')
+		if not self.backend.write_memory(image.base, image.data):
+			return False
+
+		if self.verify_eeprom:
+			return self.verify_eeprom_image(image)
 		return True
-	
-	def write_value(self, address, value):
-		clean_value = value.lower().replace('0x', '')
-		if len(clean_value) % 2 != 0:
-			clean_value = '0' + clean_value
-
-		byte_data = bytes.fromhex(clean_value)
-		reversed_byte_data = byte_data[::-1]
-
-		print(f"Numeric address: {int(address, 16)}")
-		print(f"Original Hex Value: {value}")
-		print(f"Byte Data (original): {byte_data}")
-		print(f"Reversed Byte Data: {reversed_byte_data}")
-
-		if len(byte_data) <= 1: # 8-bit value
-			return self.run_command('-c', 'ID=0', 'SWD', f'freq={self.frequency}', '-w8', address, value)
-		elif len(byte_data) <= 4: # 32-bit value
-			return self.run_command('-c', 'ID=0', 'SWD', f'freq={self.frequency}', '-w32', address, value)
-		else:
-			return self.write_byte_by_byte(address, reversed_byte_data, byte_data)
-	
-	def write_byte_by_byte(self, address, reversed_byte_data, byte_data):
-		num_address = int(address, 16)
-		if address == '0x08080008':
-			byte_data = reversed_byte_data
-
-		for i, byte in enumerate(byte_data):
-			byte_address = f'0x{num_address + i:08X}'
-			byte_hex = f'0x{byte:02X}'
-			print(f'Writing byte {i} at address {byte_address} with value {byte_hex}')
-			result = self.run_command('-c', 'ID=0', 'SWD', f'freq={self.frequency}', '-w8', byte_address, byte_hex)
-			if not result:
-				return False
+
+	def verify_eeprom_image(self, image):
+		# one read of the whole range instead of verifying every field
+		data = self.backend.read_memory(image.base, len(image))
+		if data is None:
+			print('Error while reading back EEPROM')
+			self.eeprom_mismatch = ['read back failed']
+			return False
+
+		self.eeprom_mismatch = image.mismatched_fields(data)
+		if self.eeprom_mismatch:
+			print('EEPROM fields that differ after writing: ', self.eeprom_mismatch)
+			return False
+
+		print('EEPROM verified')
 		return True
 
+	def eeprom_error(self):
+		if self.eeprom_mismatch:
+			return 'EEPROM verification failed: ' + ', '.join(self.eeprom_mismatch)
+		return 'Error while writing to eeprom'
+
 	def run_command(self, *args):
+		return self.query_command(*args) is not None
+
+	def query_command(self, *args):
+		# returns the command result for parsing its output, None if the command failed
 		print('Running command: ', args)
 		cmd = [self.stlink_path] + list(args)
-		result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+		result = StreamingCommand(cmd, STLINK_PATTERNS, self.command_timeout, self.command_max_time, self.print_progress).run()
 
-		print('run_cmd result: ', result)
+		print('run_cmd result: ', result.returncode, result.output)
 
-		if 'No ST-LINK detected!' in result.stdout:
-			return False
-		elif 'Elf Loader could not be transfered to device.' in result.stdout:
-			return False
-		elif 'Read out protection is activated.' in result.stdout:
-			return False
-		elif 'Error occured during program operation!' in result.stdout:
-			return False
-		elif 'Unexpected error' in result.stdout:
-			return False
-		
-		if result.returncode == 0:
-			return True
-	
-		return True
-		
+		if not result.ok:
+			print('Command failed: ', result.failure or f'exit code {result.returncode}')
+			if result.probe_error and self.backend is not None:
+				self.backend.probe_error = True
+			return None
+		return result
+
+	@staticmethod
+	def print_progress(line):
+		print('Progress: ', line)
 
 	def load_config(self):
 		# load configuration from file only from the STM section
@@ -216,7 +317,20 @@ class UploadSTM:
 		self.boot_address = config['STM']['Flash_Boot_Address']
 		self.start_address = config['STM']['Flash_Start_Address']
 		self.frequency = config['STM']['Frequency']
+		self.verify_mode = config['STM'].get('Verify_Mode', 'readback')
+		self.verify_eeprom = config['STM'].getboolean('Verify_Eeprom', True)
+		self.swd_autotune = config['STM'].getboolean('Swd_Autotune', False)
+		self.sector_size = int(config['STM'].get('Flash_Sector_Size', '0x1000'), 16)
 		self.stlink_path = config['STM']['STLink_Path']
+		self.command_timeout = config['STM'].getfloat('Command_Timeout', 30)
+		self.command_max_time = config['STM'].getfloat('Command_Max_Time', 300)
+		self.mode = config['STM'].get('Mode', 'steps')
+		if self.rework is None:
+			self.rework = config['STM'].getboolean('Rework_Mode', False)
+		self.backend_name = config['STM'].get('Backend', 'stlink_cli')
+		self.openocd_path = config['STM'].get('OpenOCD_Path', 'openocd')
+		self.openocd_target = config['STM'].get('OpenOCD_Target', 'target/stm32l0.cfg')
+		self.openocd_tcl_port = config['STM'].get('OpenOCD_Tcl_Port', '6666')
 
 		if self.device == 'GW100':
 			self.application = config['STM']['App_Path_GW100']
@@ -234,6 +348,20 @@ class UploadSTM:
 			self.application = config['STM']['App_Path_Default']
 			self.eeprom_file = 'data/data_gw_100.json'
 
+		if self.eeprom_override:
+			self.eeprom_file = self.eeprom_override
 
+	def create_backend(self):
+		# openocd keeps one probe session for the whole board, ST-LINK_CLI is the fallback
+		if self.backend_name == 'openocd':
+			# every probe gets its own TCL port when several boards are programmed at once
+			tcl_port = int(self.openocd_tcl_port) + self.probe_id
+			return OpenOCDBackend(self.openocd_path, self.openocd_target, self.frequency, tcl_port, self.probe_serial, command_timeout=self.command_max_time)
+		return STLinkCLIBackend(self.run_command, self.frequency, self.probe_id, self.query_command)
 
-	
+	def openocd_command(self):
+		return openocd_command(self.openocd_path, self.openocd_target, self.frequency, self.probe_serial) + [
+			'-c', 'gdb_port disabled',
+			'-c', 'tcl_port disabled',
+			'-c', 'telnet_port disabled',
+		]
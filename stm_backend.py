@@ -0,0 +1,414 @@
+import os
+import re
+import zlib
+import time
+import random
+import socket
+import tempfile
+import subprocess
+
+from eeprom import EEPROM_BASE, EEPROM_ERASED
+from erase_plan import rdp_level
+
+# STM32L0 memory map
+FLASH_BASE = 0x08000000
+FLASH_SIZE = 0x30000 # 192 kB
+FLASH_ERASED = 0x00
+EEPROM_SIZE = 0x1800 # 6 kB, two banks
+
+# flash interface registers used for unlocking the data EEPROM
+FLASH_PECR = 0x40022004
+FLASH_PEKEYR = 0x4002200C
+FLASH_OPTR = 0x4002201C # RDP byte in bits 7:0
+PEKEY1 = 0x89ABCDEF
+PEKEY2 = 0x02030405
+
+TCL_TERMINATOR = b'\x1a'
+PROBE_SERIAL_PATTERN = re.compile(r'ST-LINK SN\s*:\s*(\w+)')
+# OpenOCD errors of the SWD link itself, not of the flash operation
+OPENOCD_PROBE_ERROR = re.compile(r'(?i)\b(?:SWD|DAP|transport)\b|not examined|timed? ?out')
+RDP_PATTERN = re.compile(r'(?:Read [Oo]ut [Pp]rotection|RDP)\s*:\s*(?:Level\s*(\d)|(0x[0-9A-Fa-f]+))')
+
+
+def openocd_command(openocd_path, target_cfg, frequency, probe_serial=None):
+	"""OpenOCD command line for an ST-LINK on SWD, without any port settings"""
+	cmd = [openocd_path, '-f', 'interface/stlink.cfg']
+	if probe_serial:
+		cmd += ['-c', f'adapter serial {probe_serial}']
+	cmd += [
+		'-c', 'transport select hla_swd',
+		'-f', target_cfg,
+		'-c', f'adapter speed {frequency}',
+	]
+	return cmd
+
+
+class STLinkCLIBackend:
+	"""Fallback backend, every operation is a separate ST-LINK_CLI process"""
+	checksum_verify = False # no CRC on the probe side, programming keeps -V
+
+	def __init__(self, run_command, frequency, probe_id=0, query_command=None):
+		self.run_command = run_command
+		self.query_command = query_command
+		self.frequency = frequency
+		self.probe_id = probe_id
+		self.serial = None
+		self.probe_error = False # set by the command runner on connect or communication errors
+
+	def connect_args(self, *extra):
+		return ['-c', f'ID={self.probe_id}', 'SWD', *extra, f'freq={self.frequency}']
+
+	def open(self):
+		if self.query_command:
+			listing = self.query_command('-List')
+			if listing is None:
+				return False
+			serials = PROBE_SERIAL_PATTERN.findall(listing.output)
+			if self.probe_id < len(serials):
+				self.serial = serials[self.probe_id]
+		elif not self.run_command('-List'):
+			return False
+		return self.run_command(*self.connect_args('UR'), 'V', '-NoPrompt')
+
+	def probe_serial(self):
+		return self.serial
+
+	def set_frequency(self, frequency):
+		# every command connects again, the next one uses the new clock
+		self.frequency = frequency
+		return True
+
+	def close(self):
+		pass
+
+	def remove_protection(self):
+		return self.run_command(*self.connect_args('UR'), '-OB', 'RDP=0', '-V', '-NoPrompt', '-Run')
+
+	def erase_sectors(self, first, last):
+		return self.run_command(*self.connect_args(), '-SE', str(first), str(last), '-NoPrompt')
+
+	def read_protection_level(self):
+		if not self.query_command:
+			return None
+		result = self.query_command(*self.connect_args('UR'), '-rOB', '-NoPrompt')
+		if result is None:
+			return None
+		match = RDP_PATTERN.search(result.output)
+		if not match:
+			print('No read out protection found in the option bytes')
+			return None
+		if match.group(1) is not None:
+			return int(match.group(1))
+		return rdp_level(int(match.group(2), 16))
+
+	def program(self, path, address, verify=True):
+		verify_args = ['-V'] if verify else []
+		return self.run_command(*self.connect_args('UR'), '-P', path, f'0x{address:08X}', *verify_args, '-NoPrompt', '-Run')
+
+	def write_memory(self, address, data):
+		# ST-LINK_CLI programs from a file, the CLI has to be able to open it so it is closed before running
+		with tempfile.NamedTemporaryFile(suffix='.bin', delete=False) as file:
+			file.write(data)
+			block_file = file.name
+
+		try:
+			return self.run_command(*self.connect_args(), '-P', block_file, f'0x{address:08X}', '-NoPrompt')
+		finally:
+			os.remove(block_file)
+
+	def read_memory(self, address, size):
+		with tempfile.NamedTemporaryFile(suffix='.bin', delete=False) as file:
+			dump_file = file.name
+
+		try:
+			if not self.run_command(*self.connect_args(), '-Dump', f'0x{address:08X}', str(size), dump_file, '-NoPrompt'):
+				return None
+			with open(dump_file, 'rb') as file:
+				data = file.read()
+			if len(data) != size:
+				print(f'Dump returned {len(data)} B instead of {size} B')
+				return None
+			return data
+		finally:
+			os.remove(dump_file)
+
+	def region_matches(self, digest, address):
+		# -Cksum is only a byte sum, the region is read back and compared by CRC32 instead
+		data = self.read_memory(address, digest.size)
+		if data is None:
+			return None
+		return zlib.crc32(data) == digest.crc32
+
+
+class OpenOCDBackend:
+	"""Keeps one probe connection open for the whole board.
+
+	OpenOCD is started once and driven over its TCL RPC socket, so the SWD
+	connection is set up only once instead of for every step.
+	"""
+	checksum_verify = True # verify_image_checksum computes the CRC on the target
+
+	def __init__(self, openocd_path, target_cfg, frequency, tcl_port=6666, probe_serial=None, start_timeout=10, command_timeout=300):
+		self.openocd_path = openocd_path
+		self.target_cfg = target_cfg
+		self.frequency = frequency
+		self.tcl_port = int(tcl_port)
+		self.probe_serial_number = probe_serial
+		self.start_timeout = start_timeout
+		self.command_timeout = command_timeout # a whole flash write or verify has to fit in it
+		self.process = None
+		self.sock = None
+		self.probe_error = False # a failure was a connect or communication error
+
+	def open(self):
+		cmd = openocd_command(self.openocd_path, self.target_cfg, self.frequency, self.probe_serial_number) + [
+			'-c', f'tcl_port {self.tcl_port}',
+			'-c', 'gdb_port disabled',
+			'-c', 'telnet_port disabled',
+		]
+		print('Starting OpenOCD: ', cmd)
+		try:
+			self.process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+		except OSError as e:
+			print('Error while starting OpenOCD: ', e)
+			return False
+
+		# until reset halt answers, any failure means the probe did not reach the target
+		self.probe_error = True
+		deadline = time.monotonic() + self.start_timeout
+		while time.monotonic() < deadline:
+			if self.process.poll() is not None:
+				print('OpenOCD exited with code: ', self.process.returncode)
+				return False
+			try:
+				self.sock = socket.create_connection(('127.0.0.1', self.tcl_port), timeout=self.start_timeout)
+				self.sock.settimeout(self.command_timeout)
+				break
+			except OSError:
+				time.sleep(0.1)
+		else:
+			print('OpenOCD did not open the TCL port in time')
+			self.close()
+			return False
+
+		if self.command('reset halt') is None:
+			return False
+		self.probe_error = False
+		return True
+
+	def close(self):
+		if self.sock:
+			self.command('shutdown')
+		if self.sock:
+			# call() drops the socket itself when it fails
+			self.sock.close()
+			self.sock = None
+		if self.process:
+			try:
+				self.process.wait(timeout=5)
+			except subprocess.TimeoutExpired:
+				self.process.kill()
+			self.process = None
+
+	def probe_serial(self):
+		return self.probe_serial_number
+
+	def set_frequency(self, frequency):
+		if self.command(f'adapter speed {frequency}') is None:
+			return False
+		self.frequency = frequency
+		return True
+
+	def call(self, cmd):
+		"""Runs a TCL command, returns (error code, result), error code None if the connection is gone"""
+		if not self.sock:
+			return None, ''
+
+		# catch is substituted before $_m, so the reply is "<error code> <result>"
+		reply = bytearray()
+		try:
+			self.sock.sendall(f'concat [catch {{{cmd}}} _m] $_m'.encode() + TCL_TERMINATOR)
+			while not reply.endswith(TCL_TERMINATOR):
+				chunk = self.sock.recv(4096)
+				if not chunk:
+					print('OpenOCD closed the connection')
+					self.probe_error = True
+					return None, ''
+				reply.extend(chunk)
+		except OSError as e:
+			# a late reply would be taken as the answer to the next command, the socket is dropped
+			print(f'OpenOCD command "{cmd}" failed: {e}')
+			self.probe_error = True
+			self.sock.close()
+			self.sock = None
+			return None, ''
+
+		code, _, result = reply[:-1].decode(errors='replace').partition(' ')
+		return int(code), result
+
+	def command(self, cmd):
+		"""Runs a TCL command, returns its result or None if it failed"""
+		code, result = self.call(cmd)
+		if code != 0:
+			print(f'OpenOCD command "{cmd}" failed: {result}')
+			if OPENOCD_PROBE_ERROR.search(result):
+				self.probe_error = True
+			return None
+		return result
+
+	def remove_protection(self):
+		# unlocking drops RDP to level 0 (mass erasing the chip), the new option bytes load on reset
+		if self.command('stm32lx unlock 0') is None:
+			return False
+		return self.command('reset halt') is not None
+
+	def erase_sectors(self, first, last):
+		return self.command(f'flash erase_sector 0 {first} {last}') is not None
+
+	def read_protection_level(self):
+		result = self.command(f'read_memory 0x{FLASH_OPTR:08X} 32 1')
+		if result is None:
+			return None
+		return rdp_level(int(result, 16) & 0xFF)
+
+	def program(self, path, address, verify=True):
+		path = path.replace('\\', '/')
+		if self.command(f'flash write_image erase {{{path}}} 0x{address:08X} bin') is None:
+			return False
+		if not verify:
+			return True
+		return self.command(f'verify_image {{{path}}} 0x{address:08X} bin') is not None
+
+	def write_memory(self, address, data):
+		# the data EEPROM has to be unlocked through PEKEYR before it takes writes
+		eeprom = EEPROM_BASE <= address < EEPROM_BASE + EEPROM_SIZE
+		if eeprom:
+			if self.command(f'mww 0x{FLASH_PEKEYR:08X} 0x{PEKEY1:08X}; mww 0x{FLASH_PEKEYR:08X} 0x{PEKEY2:08X}') is None:
+				return False
+
+		try:
+			values = ' '.join(f'0x{byte:02X}' for byte in data)
+			return self.command(f'write_memory 0x{address:08X} 8 {{{values}}}') is not None
+		finally:
+			if eeprom:
+				# set PELOCK again
+				self.command(f'mww 0x{FLASH_PECR:08X} 0x00000001')
+
+	def read_memory(self, address, size):
+		result = self.command(f'read_memory 0x{address:08X} 8 {size}')
+		if result is None:
+			return None
+		return bytes(int(value, 16) for value in result.split())
+
+	def region_matches(self, digest, address):
+		# CRC is computed on the target, the image is not read back
+		path = digest.path.replace('\\', '/')
+		code, result = self.call(f'verify_image_checksum {{{path}}} 0x{address:08X} bin')
+		if code is None:
+			return None
+		# a mismatch is reported as an error of the command
+		return code == 0
+
+
+class FakeBackend:
+	"""In-process stand-in for a probe and an STM32L0, used without hardware"""
+	checksum_verify = True
+
+	def __init__(self, fail_on=(), read_out_protection=False, sector_size=0x1000, serial='FAKE0000', max_frequency=None):
+		self.fail_on = set(fail_on)
+		self.sector_size = sector_size
+		self.serial = serial
+		self.frequency = None
+		self.max_frequency = max_frequency # reads above this SWD clock return corrupted data
+		self.read_out_protection = read_out_protection
+		self.connected = False
+		self.probe_error = False
+		self.operations = []
+		self.flash = bytearray([FLASH_ERASED]) * FLASH_SIZE
+		self.eeprom = bytearray([EEPROM_ERASED]) * EEPROM_SIZE
+
+	def _operation(self, name, *args):
+		self.operations.append((name,) + args)
+		if name in self.fail_on:
+			print(f'Fake backend: simulated failure of {name}')
+			return False
+		return name == 'open' or self.connected
+
+	def _region(self, address, size):
+		if FLASH_BASE <= address and address + size <= FLASH_BASE + FLASH_SIZE:
+			return self.flash, address - FLASH_BASE
+		if EEPROM_BASE <= address and address + size <= EEPROM_BASE + EEPROM_SIZE:
+			return self.eeprom, address - EEPROM_BASE
+		raise ValueError(f'Address range 0x{address:08X}+{size} is not mapped')
+
+	def open(self):
+		if not self._operation('open'):
+			return False
+		self.connected = True
+		return True
+
+	def close(self):
+		self.operations.append(('close',))
+		self.connected = False
+
+	def probe_serial(self):
+		return self.serial
+
+	def set_frequency(self, frequency):
+		self.operations.append(('set_frequency', frequency))
+		self.frequency = int(frequency)
+		return True
+
+	def remove_protection(self):
+		if not self._operation('remove_protection'):
+			return False
+		if self.read_out_protection:
+			# regression to level 0 mass erases flash and EEPROM
+			self.flash[:] = bytes([FLASH_ERASED]) * FLASH_SIZE
+			self.eeprom[:] = bytes([EEPROM_ERASED]) * EEPROM_SIZE
+			self.read_out_protection = False
+		return True
+
+	def erase_sectors(self, first, last):
+		if not self._operation('erase_sectors', first, last):
+			return False
+		start = first * self.sector_size
+		end = min((last + 1) * self.sector_size, FLASH_SIZE)
+		self.flash[start:end] = bytes([FLASH_ERASED]) * (end - start)
+		return True
+
+	def read_protection_level(self):
+		if not self._operation('read_protection_level'):
+			return None
+		return 1 if self.read_out_protection else 0
+
+	def program(self, path, address, verify=True):
+		if not self._operation('program', path, address):
+			return False
+		with open(path, 'rb') as file:
+			data = file.read()
+		memory, offset = self._region(address, len(data))
+		memory[offset:offset + len(data)] = data
+		return True
+
+	def write_memory(self, address, data):
+		if not self._operation('write_memory', address, len(data)):
+			return False
+		memory, offset = self._region(address, len(data))
+		memory[offset:offset + len(data)] = data
+		return True
+
+	def read_memory(self, address, size):
+		if not self._operation('read_memory', address, size):
+			return None
+		memory, offset = self._region(address, size)
+		data = bytearray(memory[offset:offset + size])
+		if self.max_frequency and self.frequency and self.frequency > self.max_frequency:
+			data[random.randrange(size)] ^= 0xFF
+		return bytes(data)
+
+	def region_matches(self, digest, address):
+		if not self._operation('region_matches', address, digest.size):
+			return None
+		memory, offset = self._region(address, digest.size)
+		return zlib.crc32(memory[offset:offset + digest.size]) == digest.crc32
@@ -0,0 +1,179 @@
+"""Gang programming of the STM, one ST-LINK probe per fixture slot.
+
+The attached probes are bound to the fixture slots from [STM_SLOTS] in
+config.ini, then the boards in all slots are programmed at once:
+
+	python stm_gang.py GW100 --list
+	python stm_gang.py GW100 --eui 1=70B3D5E75E000001 --eui 2=70B3D5E75E000002
+	python stm_gang.py GW100 --fake 4
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+import configparser
+import concurrent.futures
+
+from stm import UploadSTM
+from swd_clock import SwdClockTuner
+from image_cache import ImageCache
+from stm_backend import PROBE_SERIAL_PATTERN, FakeBackend
+
+
+def list_probes(stlink_path):
+	"""Serial numbers of all attached ST-LINK probes, index = probe ID for ST-LINK_CLI"""
+	try:
+		result = subprocess.run([stlink_path, '-List'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, timeout=30)
+	except (OSError, subprocess.TimeoutExpired) as e:
+		print('Error while listing ST-LINK probes: ', e)
+		return []
+	return PROBE_SERIAL_PATTERN.findall(result.stdout)
+
+
+class FixtureSlot:
+	def __init__(self, slot, probe_id, serial):
+		self.slot = slot
+		self.probe_id = probe_id
+		self.serial = serial
+
+	def __repr__(self):
+		return f'FixtureSlot({self.slot}, ID={self.probe_id}, SN={self.serial})'
+
+
+def bind_slots(serials, config_file='config.ini'):
+	"""Binds probes to fixture slots from the [STM_SLOTS] section (Slot_1 = <serial>).
+
+	Probes that are not listed get the next free slot numbers in -List order.
+	"""
+	config = configparser.ConfigParser()
+	config.read(config_file)
+	bound = {}
+	if config.has_section('STM_SLOTS'):
+		for key, serial in config['STM_SLOTS'].items():
+			if serial in serials:
+				bound[serial] = int(key.split('_')[-1])
+
+	slots = []
+	next_slot = 1
+	for probe_id, serial in enumerate(serials):
+		if serial in bound:
+			slot = bound[serial]
+		else:
+			while next_slot in bound.values() or any(s.slot == next_slot for s in slots):
+				next_slot += 1
+			slot = next_slot
+		slots.append(FixtureSlot(slot, probe_id, serial))
+	return sorted(slots, key=lambda s: s.slot)
+
+
+class GangProgrammer:
+	"""Programs the STM of several boards at once, one ST-LINK probe per fixture slot.
+
+	on_progress(slot, step) and on_result(slot, result, info) are called from
+	the worker threads for every slot separately.
+	"""
+	def __init__(self, device, slots, on_progress=None, on_result=None, backend_factory=None):
+		self.device = device
+		self.slots = slots
+		self.on_progress = on_progress
+		self.on_result = on_result
+		self.backend_factory = backend_factory # backend per slot, None = from config.ini
+		# shared so concurrent jobs don't overwrite each other's cache files
+		self.swd_tuner = SwdClockTuner()
+		self.image_cache = ImageCache()
+
+	def run(self, euis=None):
+		"""euis: {slot: EUI} with the MAC of each board, returns {slot: (result, info)}"""
+		euis = euis or {}
+		results = {}
+		with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(self.slots), 1)) as executor:
+			futures = {executor.submit(self.program_slot, slot, euis.get(slot.slot)): slot for slot in self.slots}
+			for future in concurrent.futures.as_completed(futures):
+				slot = futures[future]
+				try:
+					result, info = future.result()
+				except Exception as e:
+					result, info = False, f'Unexpected error: {e}'
+				results[slot.slot] = (result, info)
+		return results
+
+	def program_slot(self, slot, eui=None):
+		eeprom_file = self.board_profile(eui) if eui else None
+		try:
+			backend = self.backend_factory(slot) if self.backend_factory else None
+			stm = UploadSTM(self.device, backend, probe_id=slot.probe_id, probe_serial=slot.serial,
+				eeprom_file=eeprom_file, progress=lambda step: self.report_progress(slot, step))
+			stm.swd_tuner = self.swd_tuner
+			stm.image_cache = self.image_cache
+			result, info = stm.upload_stm()
+		finally:
+			if eeprom_file:
+				os.remove(eeprom_file)
+
+		print(f'[INFO] Slot {slot.slot}: {info}')
+		if self.on_result:
+			self.on_result(slot.slot, result, info)
+		return result, info
+
+	def report_progress(self, slot, step):
+		print(f'[INFO] Slot {slot.slot}: {step}')
+		if self.on_progress:
+			self.on_progress(slot.slot, step)
+
+	def board_profile(self, eui):
+		# copy of the device profile with the EUI of this board
+		stm = UploadSTM(self.device)
+		stm.load_config()
+		with open(stm.eeprom_file, 'r') as file:
+			data = json.load(file)
+		for item in data:
+			if item['name'] == 'My TX EUI 1':
+				item['value'] = eui
+
+		with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as file:
+			json.dump(data, file, indent=4)
+			return file.name
+
+
+def parse_eui(text):
+	"""'2=70B3D5E75E000001' -> (2, '70B3D5E75E000001')"""
+	slot, _, eui = text.partition('=')
+	if not slot.isdigit() or not eui:
+		raise argparse.ArgumentTypeError(f'expected SLOT=EUI, got {text}')
+	return int(slot), eui
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Programs the STM of the boards in all fixture slots at once')
+	parser.add_argument('device', help='GW100, FM20, Agrifence, Zap! or any other name for the default application')
+	parser.add_argument('--list', action='store_true', help='only show which probe is bound to which slot')
+	parser.add_argument('--eui', type=parse_eui, action='append', default=[], metavar='SLOT=EUI', help='EUI written to the board in the slot')
+	parser.add_argument('--fake', type=int, default=0, metavar='COUNT', help='program COUNT in-process fake boards instead of probes')
+	args = parser.parse_args()
+
+	config = configparser.ConfigParser()
+	config.read('config.ini')
+	if args.fake:
+		serials = [f'FAKE{index:04d}' for index in range(args.fake)]
+	else:
+		serials = list_probes(config['STM']['STLink_Path'])
+	slots = bind_slots(serials)
+	for slot in slots:
+		print(slot)
+	if not slots:
+		print('No ST-LINK probe found')
+		sys.exit(1)
+	if args.list:
+		return
+
+	backend_factory = (lambda slot: FakeBackend(serial=slot.serial)) if args.fake else None
+	results = GangProgrammer(args.device, slots, backend_factory=backend_factory).run(dict(args.eui))
+	for slot, (result, info) in sorted(results.items()):
+		print(f'Slot {slot}: ' + ('OK' if result else 'FAILED') + f', {info}')
+	sys.exit(0 if all(result for result, _ in results.values()) else 1)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,148 @@
+import os
+import shutil
+import tempfile
+
+from cli_runner import StreamingCommand, OPENOCD_PATTERNS
+from eeprom import EEPROM_BASE, EepromImage
+from erase_plan import RDP_LEVEL_0
+from stm_backend import FLASH_PECR, FLASH_PEKEYR, FLASH_OPTR, PEKEY1, PEKEY2
+
+# runs a step body, a failing step stops the script with a non-zero exit code
+STEP_PROC = '''proc step {name body} {
+	echo "STEP $name"
+	if {[catch {uplevel 1 $body} err]} {
+		echo "FAILED $name: $err"
+		shutdown error
+	}
+}
+'''
+DONE_MARKER = 'JOB DONE'
+
+
+def tcl_path(path):
+	return '{' + os.path.abspath(path).replace('\\', '/') + '}'
+
+
+class StmJobStep:
+	def __init__(self, name, error, commands):
+		self.name = name
+		self.error = error # message shown in the GUI log if the step fails
+		self.commands = commands
+
+
+class StmJobCompiler:
+	"""Compiles the upload_stm sequence of one device into a single OpenOCD script"""
+	def __init__(self, uploader, work_dir):
+		self.uploader = uploader
+		self.work_dir = work_dir
+
+	def compile(self):
+		up = self.uploader
+		steps = [
+			StmJobStep('list', 'Error while searching for STM', ['init']),
+			StmJobStep('connect', 'Error while searching for STM', ['reset halt']),
+			StmJobStep('rdp', 'Error while erasing STM', [self.rdp_command()]),
+			StmJobStep('erase', 'Error while erasing STM', self.erase_commands()),
+			StmJobStep('startloader', 'Error while uploading startloader', self.program_commands(up.startloader, up.start_address)),
+			StmJobStep('bootloader', 'Error while uploading bootloader', self.program_commands(up.bootloader, up.boot_address)),
+			StmJobStep('application', 'Error while uploading application', self.program_commands(up.application, up.app_address)),
+		]
+
+		image = EepromImage.from_profile(up.eeprom_file)
+		if len(image):
+			steps.append(StmJobStep('eeprom', 'Error while writing to eeprom', self.eeprom_commands(image.data, 'eeprom.bin', image.base)))
+		return steps
+
+	def rdp_command(self):
+		# the option bytes are read on the target, the regression only runs when RDP is set
+		return f'if {{([mrw 0x{FLASH_OPTR:08X}] & 0xFF) != 0x{RDP_LEVEL_0:02X}}} {{ stm32lx unlock 0; reset halt }}'
+
+	def erase_commands(self):
+		ranges = self.uploader.erase_planner().sector_ranges(self.uploader.flash_images())
+		return [f'flash erase_sector 0 {first} {last}' for first, last in ranges]
+
+	def program_commands(self, path, address):
+		# sectors were already erased by the erase step
+		verify = 'verify_image_checksum' if self.uploader.verify_mode == 'checksum' else 'verify_image'
+		return [
+			f'flash write_image {tcl_path(path)} {address} bin',
+			f'{verify} {tcl_path(path)} {address} bin',
+		]
+
+	def eeprom_commands(self, data, file_name, address=EEPROM_BASE):
+		# written and read back in one block
+		path = os.path.join(self.work_dir, file_name)
+		with open(path, 'wb') as file:
+			file.write(data)
+		return [
+			f'mww 0x{FLASH_PEKEYR:08X} 0x{PEKEY1:08X}',
+			f'mww 0x{FLASH_PEKEYR:08X} 0x{PEKEY2:08X}',
+			f'load_image {tcl_path(path)} 0x{address:08X} bin',
+			f'mww 0x{FLASH_PECR:08X} 0x00000001',
+			f'verify_image {tcl_path(path)} 0x{address:08X} bin',
+		]
+
+	def write_script(self, steps):
+		lines = [STEP_PROC]
+		for step in steps:
+			body = '\n'.join(f'\t{command}' for command in step.commands)
+			lines.append(f'step {step.name} {{\n{body}\n}}')
+		lines.append(f'echo "{DONE_MARKER}"')
+		lines.append('reset run')
+		lines.append('shutdown')
+
+		path = os.path.join(self.work_dir, 'job.tcl')
+		with open(path, 'w') as file:
+			file.write('\n'.join(lines) + '\n')
+		return path
+
+
+class StmJobRunner:
+	"""Runs a compiled job in one OpenOCD process and maps a failure to its step"""
+	def __init__(self, uploader, timeout=300):
+		self.uploader = uploader
+		self.timeout = timeout
+
+	def run(self):
+		for path in (self.uploader.startloader, self.uploader.bootloader, self.uploader.application, self.uploader.eeprom_file):
+			if not os.path.exists(path):
+				print('Missing file for STM job: ', path)
+				return False, f'File not found: {path}'
+
+		work_dir = tempfile.mkdtemp(prefix='stm_job_')
+		try:
+			compiler = StmJobCompiler(self.uploader, work_dir)
+			try:
+				steps = compiler.compile()
+			except (ValueError, KeyError) as e:
+				print('Error while compiling STM job: ', e)
+				return False, 'Error while writing to eeprom'
+			script = compiler.write_script(steps)
+
+			cmd = self.uploader.openocd_command() + ['-f', script]
+			print('Running STM job: ', cmd)
+			result = StreamingCommand(cmd, OPENOCD_PATTERNS, self.uploader.command_timeout, self.timeout, self.uploader.print_progress).run()
+
+			print('STM job output: ', result.output)
+			if not result.ok or DONE_MARKER not in result.lines:
+				return self.failure(steps, result.lines, result.failure or f'exit code {result.returncode}')
+			return True, 'Process finished successfully'
+		finally:
+			shutil.rmtree(work_dir, ignore_errors=True)
+
+	def failure(self, steps, lines, reason):
+		# the last started step is the one that failed
+		started = None
+		for line in lines:
+			if line.startswith('STEP '):
+				started = line[5:].strip()
+			elif line.startswith('FAILED '):
+				print(line)
+
+		for step in steps:
+			if step.name == started:
+				print(f'STM job failed in step {step.name} ({reason})')
+				return False, step.error
+		# nothing started, OpenOCD could not even load the configuration / find the probe
+		print(f'STM job failed before the first step ({reason})')
+		return False, steps[0].error
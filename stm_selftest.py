@@ -0,0 +1,254 @@
+"""UploadSTM against the in-process FakeBackend, no probe or board needed.
+
+Every check runs in its own scratch directory with a config.ini, images
+and an EEPROM profile of its own, uploads to a fake STM32L0 and then looks
+at the fake chip and the operations the backend was asked for:
+
+	python stm_selftest.py
+	python stm_selftest.py --verbose
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import contextlib
+
+from stm import UploadSTM
+from eeprom import EepromImage
+from erase_plan import ErasePlanner
+from swd_clock import SwdClockTuner
+from stm_backend import FakeBackend, FLASH_BASE
+
+IMAGES = {
+	# name: (config key, address, size)
+	'startloader': ('Startloader_Path', 0x08000000, 0x800),
+	'bootloader': ('Bootloader_Path', 0x08001000, 0x1800),
+	'application': ('App_Path_Default', 0x08010000, 0x3000),
+}
+
+PROFILE = [
+	{'name': 'Alarm on/off', 'address': '0x08080001', 'value': '4'},
+	{'name': 'LCD contrast', 'address': '0x08080003', 'value': '30'},
+	{'name': 'EUI', 'address': '0x08080008', 'value': '70B3D5E75E000001'},
+]
+
+
+class CheckFailed(Exception):
+	pass
+
+
+class LinkLossBackend(FakeBackend):
+	"""Loses the target above max_frequency, like ST-LINK_CLI failing to connect"""
+	def read_memory(self, address, size):
+		if self.max_frequency and self.frequency and self.frequency > self.max_frequency:
+			self.operations.append(('read_memory', address, size))
+			self.probe_error = True
+			return None
+		return super().read_memory(address, size)
+
+	def program(self, path, address, verify=True):
+		if 'program' in self.fail_on:
+			self.probe_error = True
+		return super().program(path, address, verify)
+
+
+def check(condition, message):
+	if not condition:
+		raise CheckFailed(message)
+
+
+@contextlib.contextmanager
+def station(**settings):
+	"""Scratch directory with config.ini, images and profile, the cwd while the check runs"""
+	cwd = os.getcwd()
+	with tempfile.TemporaryDirectory() as directory:
+		os.chdir(directory)
+		try:
+			os.mkdir('data')
+			stm = {
+				'STLink_Path': 'ST-LINK_CLI',
+				'STM_Directory': directory,
+				'Flash_App_Address': hex(IMAGES['application'][1]),
+				'Flash_Boot_Address': hex(IMAGES['bootloader'][1]),
+				'Flash_Start_Address': hex(IMAGES['startloader'][1]),
+				'Flash_Sector_Size': '0x1000',
+				'Verify_Mode': 'readback',
+				'Verify_Eeprom': 'yes',
+				'Frequency': '240',
+				'Swd_Autotune': 'no',
+				'Mode': 'steps',
+				'Rework_Mode': 'no',
+			}
+			for name, (key, address, size) in IMAGES.items():
+				write_image(f'{name}.bin', size, address)
+				stm[key] = f'{name}.bin'
+			stm.update(settings)
+			with open('config.ini', 'w') as file:
+				file.write('[STM]\n' + ''.join(f'{key} = {value}\n' for key, value in stm.items()))
+			with open('profile.json', 'w') as file:
+				json.dump(PROFILE, file)
+			yield directory
+		finally:
+			os.chdir(cwd)
+
+
+def write_image(path, size, seed):
+	# no 0x00 bytes, they would look like erased flash
+	data = bytes((seed + index * 7) % 255 + 1 for index in range(size))
+	with open(path, 'wb') as file:
+		file.write(data)
+	return data
+
+
+def upload(backend, rework=None):
+	uploader = UploadSTM('Default', backend=backend, rework=rework, eeprom_file='profile.json')
+	return uploader, uploader.upload_stm()
+
+
+def operations(backend, name):
+	return [operation for operation in backend.operations if operation[0] == name]
+
+
+def flash_matches(backend, name):
+	key, address, size = IMAGES[name]
+	with open(f'{name}.bin', 'rb') as file:
+		data = file.read()
+	offset = address - FLASH_BASE
+	return backend.flash[offset:offset + len(data)] == data
+
+
+def check_full_sequence():
+	with station():
+		backend = FakeBackend(read_out_protection=True)
+		_, (result, info) = upload(backend)
+		check(result, f'upload failed: {info}')
+		check(operations(backend, 'remove_protection'), 'RDP was not removed')
+		check(not operations(backend, 'erase_sectors'), 'sectors erased after the RDP regression')
+		for name in IMAGES:
+			check(flash_matches(backend, name), f'{name} not in flash')
+		image = EepromImage.from_profile('profile.json')
+		check(bytes(backend.eeprom[:len(image)]) == bytes(image.data), 'EEPROM differs from the profile')
+		check(not backend.connected, 'backend not closed')
+
+
+def check_erase_plan():
+	with station():
+		backend = FakeBackend()
+		uploader, (result, info) = upload(backend)
+		check(result, f'upload failed: {info}')
+		check(not operations(backend, 'remove_protection'), 'RDP removed at level 0')
+		planner = ErasePlanner(FLASH_BASE, 0x1000)
+		expected = planner.sector_ranges([(f'{name}.bin', address) for name, (_, address, _) in IMAGES.items()])
+		erased = [(first, last) for _, first, last in operations(backend, 'erase_sectors')]
+		check(erased == expected, f'erased {erased}, planned {expected}')
+
+
+def check_rework():
+	with station():
+		backend = FakeBackend()
+		_, (result, info) = upload(backend)
+		check(result, f'upload failed: {info}')
+
+		backend.operations.clear()
+		_, (result, info) = upload(backend, rework=True)
+		check(result, f'rework failed: {info}')
+		check(not operations(backend, 'program'), 'unchanged regions programmed again')
+
+		write_image('application.bin', IMAGES['application'][2], 0x55)
+		backend.operations.clear()
+		_, (result, info) = upload(backend, rework=True)
+		check(result, f'rework failed: {info}')
+		programmed = [address for _, _, address in operations(backend, 'program')]
+		check(programmed == [IMAGES['application'][1]], f'programmed {programmed} instead of the application only')
+		check(flash_matches(backend, 'application'), 'changed application not in flash')
+
+
+def check_eeprom_verify():
+	with station():
+		# reads above the clock limit come back corrupted, the verification has to notice
+		backend = FakeBackend(max_frequency=1800)
+		backend.set_frequency(4000)
+		uploader, (result, info) = upload(backend)
+		check(not result, 'corrupted EEPROM read back passed')
+		check(info.startswith('EEPROM verification failed'), f'unexpected error: {info}')
+		check(uploader.eeprom_mismatch, 'no mismatching field reported')
+
+
+def check_failed_step():
+	with station():
+		backend = FakeBackend(fail_on=['erase_sectors'])
+		_, (result, info) = upload(backend)
+		check(not result and info == 'Error while erasing STM', f'unexpected result: {result}, {info}')
+		check(not operations(backend, 'program'), 'programmed after a failed erase')
+
+
+def check_swd_calibration():
+	with station(Swd_Autotune='yes'):
+		backend = FakeBackend(max_frequency=1800)
+		uploader, (result, info) = upload(backend)
+		check(result, f'upload failed: {info}')
+		check(uploader.swd_tuner.frequency(backend.serial) == 1800, f'calibrated to {uploader.swd_tuner.frequency(backend.serial)} kHz')
+
+		# the next board uses the stored clock without calibrating again
+		backend.operations.clear()
+		_, (result, info) = upload(backend)
+		check(result, f'upload failed: {info}')
+		check([operation for operation in backend.operations if operation[0] == 'set_frequency'] == [('set_frequency', 1800)], 'calibrated again')
+
+
+def check_swd_probe_errors():
+	with station(Swd_Autotune='yes'):
+		backend = LinkLossBackend(max_frequency=950)
+		uploader, (result, info) = upload(backend)
+		check(result, f'upload failed: {info}')
+		check(uploader.swd_tuner.frequency(backend.serial) == 950, f'calibrated to {uploader.swd_tuner.frequency(backend.serial)} kHz')
+		check(not backend.probe_error, 'calibration left a probe error behind')
+
+		# an upload error that is no probe error keeps the stored clock
+		os.remove('profile.json')
+		_, (result, info) = upload(backend)
+		check(not result, 'upload without an EEPROM profile passed')
+		check(SwdClockTuner().frequency(backend.serial) == 950, 'stored clock dropped after an EEPROM error')
+
+		# a probe error drops it, the next board calibrates again
+		with open('profile.json', 'w') as file:
+			json.dump(PROFILE, file)
+		backend.fail_on.add('program')
+		_, (result, info) = upload(backend)
+		check(not result, 'upload with a lost target passed')
+		check(SwdClockTuner().frequency(backend.serial) is None, 'stored clock kept after a probe error')
+
+
+CHECKS = [
+	check_full_sequence,
+	check_erase_plan,
+	check_rework,
+	check_eeprom_verify,
+	check_failed_step,
+	check_swd_calibration,
+	check_swd_probe_errors,
+]
+
+
+def main():
+	parser = argparse.ArgumentParser(description='UploadSTM checks against the fake backend')
+	parser.add_argument('--verbose', action='store_true', help='show the upload output')
+	args = parser.parse_args()
+
+	failed = 0
+	for function in CHECKS:
+		with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+			try:
+				function()
+				error = None
+			except CheckFailed as e:
+				error = e
+		name = function.__name__[len('check_'):]
+		print(f'{name:16} ' + (f'FAILED: {error}' if error else 'OK'))
+		failed += error is not None
+	sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+	main()
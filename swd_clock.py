@@ -0,0 +1,91 @@
+import json
+import threading
+
+CACHE_FILE = 'data/swd_clock.json'
+
+# SWD frequencies supported by the ST-LINK/V2 in kHz, ascending
+SUPPORTED_FREQUENCIES = [5, 15, 25, 50, 100, 125, 240, 480, 950, 1800, 4000]
+
+# calibration reads this block several times at every frequency
+TEST_ADDRESS = 0x08000000
+TEST_SIZE = 0x400
+TEST_READS = 3
+# the chosen frequency has to pass a longer run as a safety margin
+SOAK_READS = 10
+
+
+class SwdClockTuner:
+	"""Finds the fastest reliable SWD clock of a probe and remembers it per probe serial number"""
+	def __init__(self, cache_file=CACHE_FILE):
+		self.cache_file = cache_file
+		self.lock = threading.Lock()
+		self.entries = {}
+		try:
+			with open(cache_file, 'r') as file:
+				self.entries = json.load(file)
+		except (OSError, ValueError):
+			pass
+
+	def frequency(self, serial):
+		entry = self.entries.get(serial)
+		if entry:
+			return entry['frequency']
+		return None
+
+	def calibrate(self, serial, backend, start_frequency):
+		"""Steps up from start_frequency while reads stay consistent, returns the chosen frequency or None"""
+		candidates = [freq for freq in SUPPORTED_FREQUENCIES if freq >= int(start_frequency)]
+		highest = None
+		reference = None
+		for freq in candidates:
+			backend.set_frequency(freq)
+			reads = [backend.read_memory(TEST_ADDRESS, TEST_SIZE) for _ in range(TEST_READS)]
+			if reference is None and reads[0] is not None:
+				# the first (slowest) frequency provides the reference contents
+				reference = reads[0]
+			ok = reference is not None and all(data == reference for data in reads)
+			print(f'SWD clock {freq} kHz: ' + ('OK' if ok else 'unreliable'))
+			if not ok:
+				break
+			highest = freq
+
+		if highest is None:
+			print('SWD clock calibration failed, keeping the configured frequency')
+			backend.set_frequency(start_frequency)
+			return None
+
+		chosen = highest
+		backend.set_frequency(chosen)
+		if not all(backend.read_memory(TEST_ADDRESS, TEST_SIZE) == reference for _ in range(SOAK_READS)):
+			index = candidates.index(highest)
+			if index == 0:
+				print('SWD clock soak failed at the configured frequency, nothing stored')
+				backend.set_frequency(start_frequency)
+				return None
+			# marginal at the highest frequency, one step down
+			chosen = candidates[index - 1]
+			backend.set_frequency(chosen)
+		print(f'SWD clock for probe {serial}: {chosen} kHz (highest passing {highest} kHz)')
+		self.store(serial, chosen, highest)
+		return chosen
+
+	def forget(self, serial):
+		"""Called after a probe communication error, the next board calibrates again"""
+		with self.lock:
+			if self.entries.pop(serial, None) is None:
+				return
+			print(f'SWD clock for probe {serial} will be calibrated again')
+			self.save()
+
+	def store(self, serial, frequency, highest):
+		with self.lock:
+			self.entries[serial] = {'frequency': frequency, 'highest': highest}
+			self.save()
+
+	def save(self):
+		# callers hold lock
+		try:
+			with open(self.cache_file, 'w') as file:
+				json.dump(self.entries, file, indent=4)
+		except OSError as e:
+			print('Error while saving SWD clock cache: ', e)